@@ -6,10 +6,18 @@ Created on 2020年7月28日
 '''
 import logging
 import json
-from threading import RLock
+from threading import RLock, Lock, BoundedSemaphore, Event, Condition, Thread, local
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import inspect
-import urllib
+import functools
+import itertools
+import contextlib
+import time
+import collections
+import zlib
+import urllib.parse
+from multiprocessing import shared_memory, resource_tracker
 
 # class withLoggerName(object):
 #     @property
@@ -46,6 +54,59 @@ class DisabledError(Exception):
 class RpcError(Exception):
     pass
 
+class ReferenceCycleError(Exception):
+    pass
+
+#PROPERTY中表示属性未被写入
+_UNSET = object()
+
+def _PickleState(obj, cls, excluded):
+    '取得obj在cls之后的类所给出的pickle状态（dict），去除excluded中的属性'
+    _getstate = getattr(super(cls, obj), '__getstate__', None)
+    _r = None if _getstate is None else _getstate()
+    _r = dict(obj.__dict__ if _r is None else _r)
+    for _name in excluded:
+        _r.pop(_name, None)
+    return _r
+
+class PROPERTY(object):
+    '''
+            声明式属性
+        值保存在实例__dict__中以key为名的项，读取时不加锁。写入时先与当前值比较，未变化则直接返回；
+        notify为True时在PROP_LOCK内写入并调用DoNotifyPropertyChanged，否则直接写入
+        default为未写入时的值，default_func(instance)用于需要由实例决定的默认值，convert(value)在写入前转换值
+    '''
+    def __init__(self, key, default=None, default_func=None, notify=True, convert=None):
+        super(PROPERTY, self).__init__()
+        self.Key = key
+        self.Default = default
+        self.DefaultFunc = default_func
+        self.Notify = notify
+        self.Convert = convert
+        self.Name = key
+
+    def __set_name__(self, owner, name):
+        self.Name = name
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        _r = obj.__dict__.get(self.Key, _UNSET)
+        if _r is _UNSET:
+            return self.Default if self.DefaultFunc is None else self.DefaultFunc(obj)
+        return _r
+
+    def __set__(self, obj, value):
+        if not self.Convert is None:
+            value = self.Convert(value)
+        if value != self.__get__(obj):
+            if self.Notify:
+                with obj.PROP_LOCK:
+                    obj.__dict__[self.Key] = value
+                    obj.DoNotifyPropertyChanged(self.Name)
+            else:
+                obj.__dict__[self.Key] = value
+
 class mixinCommon(object):
     '''
             作为基类使用
@@ -57,177 +118,530 @@ class mixinCommon(object):
     
     @property
     def PROP_LOCK(self):
-        '属性被读写时必须获取首先获取此线程锁'
-        _r = getattr(self, '___property_lock', None)
+        '属性被写入并触发通知时获取此线程锁'
+        _r = self.__dict__.get('___property_lock')
         if _r is None:
-            _r = RLock()
-            setattr(self, '___property_lock', _r)
+            _r = self.__dict__.setdefault('___property_lock', RLock())
         return _r
         
-    @property
-    def LoggerName(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___logger_name', self.__class__.__name__)
-    @LoggerName.setter
-    def LoggerName(self, value):
-        if value != self.LoggerName:
-            with self.PROP_LOCK:
-                setattr(self, '___logger_name', str(value))
-                self.DoNotifyPropertyChanged('LoggerName')
-    
+    LoggerName = PROPERTY('___logger_name', default_func=lambda obj: obj.__class__.__name__, convert=str)
     #Enabled属性用于决定组件是否被允许完成业务逻辑，而不应该将设置Enabled作为业务逻辑的一部分，即使OnPropertyChanged事件中可以检测到Enabled的变化
-    @property
-    def Enabled(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___enabled', self.DEFAULT_ENABLED)
-    @Enabled.setter
-    def Enabled(self, value):
-        if value != self.Enabled:
-            with self.PROP_LOCK:
-                setattr(self, '___enabled', value)
-                self.DoNotifyPropertyChanged('Enabled')
-    
+    Enabled = PROPERTY('___enabled', default_func=lambda obj: obj.DEFAULT_ENABLED)
     #EOwnerData属性用于携带一部分业务中的动态数据，通常在回调函数中会将调用者实例作为首参数，通过调用者实例可以得到OwnerData
-    @property
-    def OwnerData(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___owner_data', None)
-    @OwnerData.setter
-    def OwnerData(self, value):
-        if value != self.OwnerData:
-            with self.PROP_LOCK:
-                setattr(self, '___owner_data', value)
-                self.DoNotifyPropertyChanged('OwnerData')
-
-    @property
-    def NotifyPropertyChanged(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___notify_property_changed', None)
-    @NotifyPropertyChanged.setter
-    def NotifyPropertyChanged(self, value):
-        if value != self.NotifyPropertyChanged:
-            with self.PROP_LOCK:
-                setattr(self, '___notify_property_changed', value)
-                #这里没有调用DoNotifyPropertyChanged
+    OwnerData = PROPERTY('___owner_data')
+    #这里不调用DoNotifyPropertyChanged
+    NotifyPropertyChanged = PROPERTY('___notify_property_changed', notify=False)
          
     def DoNotifyPropertyChanged(self, prop_name):
-        if callable(self.NotifyPropertyChanged):
-            self.NotifyPropertyChanged(sender=self, name=prop_name)
+        _batch = self.__dict__.get('___property_changed_batch')
+        if not _batch is None:
+            _batch.append(prop_name)
+            return
+        _notify = self.NotifyPropertyChanged
+        if callable(_notify):
+            _notify(sender=self, name=prop_name)
+
+    def __getstate__(self):
+        'pickle（如提交到进程池）时去除锁及可重建的缓存，它们在使用时重新创建'
+        return _PickleState(self, mixinCommon, ('___property_lock', '___logger', '___property_changed_batch'))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @contextlib.contextmanager
+    def PropertyChangedBatch(self):
+        '''
+                在with块内合并属性变化通知，退出时每个变化过的属性按首次变化的顺序通知一次
+            批量状态属于实例，块内其他线程对同一实例的修改也会被合并
+        '''
+        if '___property_changed_batch' in self.__dict__:
+            yield
+            return
+        _batch = self.__dict__['___property_changed_batch'] = []
+        try:
+            yield
+        finally:
+            del self.__dict__['___property_changed_batch']
+            for _name in dict.fromkeys(_batch):
+                self.DoNotifyPropertyChanged(_name)
+
+    @property
+    def Logger(self):
+        '以LoggerName命名的日志适配器，LoggerName变化后重新创建'
+        _r = self.__dict__.get('___logger')
+        if _r is None or _r.logger.name != self.LoggerName:
+            _r = self.__dict__['___logger'] = ComponentLogger(self)
+        return _r
 
     def LOG_MESSAGE(self, message, full_debug=False):
+        '返回日志消息字符串。full_debug为True时附加调用者信息；需要延迟格式化时使用Logger的full_debug参数'
         if not self.LOGGING_WITH_DEBUG or not full_debug:
             return message
         else:
-            _frame = inspect.currentframe()
-            _f_code = _frame.f_back.f_code
-            _args = inspect.getargvalues(_frame)
-            return '{message}\n\t{class_name}.{function_name}({args})\tFile "{filename}" line {lineno}'.format(message=message, filename=_f_code.co_filename, lineno=_f_code.co_firstlineno, class_name=self.__class__.__name__, function_name=_f_code.co_name, args=[_args.locals[x] for x in _args.args])
+            return str(LazyLogMessage(self, message, sys._getframe(1)))
+
+class LazyLogMessage(object):
+    '''
+            延迟格式化的日志消息
+        创建时只保存调用者的帧及行号，被处理器输出（str()）时才格式化调用者的函数名、参数及位置，格式化后释放帧。
+        格式化之前帧及其局部变量不会被释放，只在ComponentLogger内部使用，不作为返回值交给调用者
+        参数值取自格式化时的帧，日志被异步处理时可能已与调用时不同
+    '''
+    __slots__ = ('Owner', 'Message', '_frame', '_lineno', '_text')
+
+    def __init__(self, owner, message, frame):
+        self.Owner = owner
+        self.Message = message
+        self._frame = frame
+        self._lineno = frame.f_lineno
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            _f_code = self._frame.f_code
+            _args = inspect.getargvalues(self._frame)
+            self._text = '{message}\n\t{class_name}.{function_name}({args})\tFile "{filename}" line {lineno}'.format(message=self.Message, filename=_f_code.co_filename, lineno=self._lineno, class_name=self.Owner.__class__.__name__, function_name=_f_code.co_name, args=[_args.locals[x] for x in _args.args])
+            self._frame = None
+        return self._text
+
+class ComponentLogger(logging.LoggerAdapter):
+    '''
+            mixinCommon.Logger返回的日志适配器
+        级别未启用时直接返回，不创建日志消息；full_debug=True时消息为包含调用者信息的LazyLogMessage
+    '''
+    def __init__(self, owner):
+        super(ComponentLogger, self).__init__(logging.getLogger(owner.LoggerName), {})
+        self.Owner = owner
+
+    def log(self, level, msg, *args, full_debug=False, **kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        if full_debug and self.Owner.LOGGING_WITH_DEBUG:
+            #跳过logging模块中LoggerAdapter.debug等函数的帧
+            _frame = sys._getframe(1)
+            while _frame.f_code.co_filename == logging.__file__:
+                _frame = _frame.f_back
+            msg = LazyLogMessage(self.Owner, msg, _frame)
+        #使LogRecord中的位置指向调用者而不是本函数
+        kwargs.setdefault('stacklevel', 2)
+        self.logger.log(level, msg, *args, **kwargs)
 
             
 class mixinExecuteable(object):
     '''
             使继承类具有Execute函数。继承类需要实现DoExecute来执行实际的功能
     '''
-    #类的Execute函数被调用时触发。回调时的参数可参见Execute函数的实现
-    @property
-    def NotifyBeforeExecute(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___notify_before_execute', None)
-    @NotifyBeforeExecute.setter
-    def NotifyBeforeExecute(self, value):
-        if value != self.NotifyBeforeExecute:
-            with self.PROP_LOCK:
-                setattr(self, '___notify_before_execute', value)
-                self.DoNotifyPropertyChanged('NotifyBeforeExecute')
+    #Submit/ExecuteMany使用的执行器（concurrent.futures.Executor），None时使用进程内共享的线程池
+    EXECUTOR = None
+    #共享线程池的线程数，None时由ThreadPoolExecutor决定
+    SHARED_EXECUTOR_WORKERS = None
 
-    @property
-    def NotifyExecuteSuccess(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___notify_execute_success', None)
-    @NotifyExecuteSuccess.setter
-    def NotifyExecuteSuccess(self, value):
-        if value != self.NotifyExecuteSuccess:
-            with self.PROP_LOCK:
-                setattr(self, '___notify_execute_success', value)
-                self.DoNotifyPropertyChanged('NotifyExecuteSuccess')
-
-    @property
-    def NotifyExecuteError(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___notify_execute_error', None)
-    @NotifyExecuteError.setter
-    def NotifyExecuteError(self, value):
-        if value != self.NotifyExecuteError:
-            with self.PROP_LOCK:
-                setattr(self, '___notify_execute_error', value)
-                self.DoNotifyPropertyChanged('NotifyExecuteError')
+    #类的Execute函数被调用时触发。回调时的参数可参见Execute函数的实现
+    NotifyBeforeExecute = PROPERTY('___notify_before_execute')
+    NotifyExecuteSuccess = PROPERTY('___notify_execute_success')
+    NotifyExecuteError = PROPERTY('___notify_execute_error')
+    NotifyAfterExecute = PROPERTY('___notify_after_execute')
+    #Execute的调用统计（ExecuteMetrics），为None时不统计。通过EnableMetrics设置
+    Metrics = PROPERTY('___execute_metrics', notify=False)
 
-    @property
-    def NotifyAfterExecute(self):
-        with self.PROP_LOCK:
-            return getattr(self, '___notify_after_execute', None)
-    @NotifyAfterExecute.setter
-    def NotifyAfterExecute(self, value):
-        if value != self.NotifyAfterExecute:
-            with self.PROP_LOCK:
-                setattr(self, '___notify_after_execute', value)
-                self.DoNotifyPropertyChanged('NotifyAfterExecute')
+    def EnableMetrics(self, enabled=True):
+        '开启/关闭Execute的调用统计。统计按LoggerName汇总到ExecuteMetrics中，多个同名组件共用一份统计；LoggerName变化后的调用计入新名称'
+        self.Metrics = ExecuteMetrics.Get(self.LoggerName) if enabled else None
 
     def Execute(self, *args, **kwargs):
+        #每个回调属性只读取一次
+        _metrics = self.Metrics
+        if not _metrics is None:
+            if _metrics.Name != self.LoggerName:
+                _metrics = self.Metrics = ExecuteMetrics.Get(self.LoggerName)
+            _start = _metrics.Enter()
+            _failed = False
         try:
-            if callable(self.NotifyBeforeExecute):
-                self.NotifyBeforeExecute(sender=self, args=args, kwargs=kwargs)
+            _notify = self.NotifyBeforeExecute
+            if callable(_notify):
+                _notify(sender=self, args=args, kwargs=kwargs)
             _r = self.DoExecute(*args, **kwargs)
-            if callable(self.NotifyExecuteSuccess):
-                self.NotifyExecuteSuccess(sender=self, args=args, kwargs=kwargs)
+            _notify = self.NotifyExecuteSuccess
+            if callable(_notify):
+                _notify(sender=self, args=args, kwargs=kwargs)
             return _r
         except Exception as _e:
+            if not _metrics is None:
+                _failed = True
             _no_raise = False
-            if callable(self.NotifyExecuteError):
-                _no_raise = self.NotifyExecuteError(sender=self, args=args, kwargs=kwargs, error=_e)
+            _notify = self.NotifyExecuteError
+            if callable(_notify):
+                _no_raise = _notify(sender=self, args=args, kwargs=kwargs, error=_e)
             if _no_raise != True:
                 raise
         finally:
-            if callable(self.NotifyAfterExecute):
-                self.NotifyAfterExecute(sender=self, args=args, kwargs=kwargs)
+            if not _metrics is None:
+                _metrics.Exit(_start, _failed)
+            _notify = self.NotifyAfterExecute
+            if callable(_notify):
+                _notify(sender=self, args=args, kwargs=kwargs)
                 
+    async def ExecuteAsync(self, *args, **kwargs):
+        '与Execute相同，DoExecute返回awaitable（如async def实现）时等待其完成后再触发成功/失败通知'
+        _metrics = self.Metrics
+        if not _metrics is None:
+            if _metrics.Name != self.LoggerName:
+                _metrics = self.Metrics = ExecuteMetrics.Get(self.LoggerName)
+            _start = _metrics.Enter()
+            _failed = False
+        try:
+            _notify = self.NotifyBeforeExecute
+            if callable(_notify):
+                _notify(sender=self, args=args, kwargs=kwargs)
+            _r = self.DoExecute(*args, **kwargs)
+            if inspect.isawaitable(_r):
+                _r = await _r
+            _notify = self.NotifyExecuteSuccess
+            if callable(_notify):
+                _notify(sender=self, args=args, kwargs=kwargs)
+            return _r
+        except Exception as _e:
+            if not _metrics is None:
+                _failed = True
+            _no_raise = False
+            _notify = self.NotifyExecuteError
+            if callable(_notify):
+                _no_raise = _notify(sender=self, args=args, kwargs=kwargs, error=_e)
+            if _no_raise != True:
+                raise
+        finally:
+            if not _metrics is None:
+                _metrics.Exit(_start, _failed)
+            _notify = self.NotifyAfterExecute
+            if callable(_notify):
+                _notify(sender=self, args=args, kwargs=kwargs)
+
+    def __getstate__(self):
+        'pickle时去除执行器及调用统计（含锁），子进程中的实例使用默认执行器且不统计'
+        return _PickleState(self, mixinExecuteable, ('EXECUTOR', '___execute_metrics'))
+
+    def GetExecutor(self):
+        '返回Submit/ExecuteMany使用的执行器：EXECUTOR属性，未设置时为进程内共享的线程池'
+        _r = self.EXECUTOR
+        return _SharedExecutor() if _r is None else _r
+
+    def Submit(self, *args, **kwargs):
+        '''
+                在执行器中调用Execute，返回concurrent.futures.Future
+            使用进程池时实例会被pickle到子进程中执行（不含锁、EXECUTOR及Metrics），回调也在子进程中触发，因此回调也须可被pickle
+        '''
+        return self.GetExecutor().submit(self.Execute, *args, **kwargs)
+
+    def ExecuteMany(self, items, max_concurrency=8, executor=None, **kwargs):
+        '''
+                以有限的并发数对items中的每一项调用Execute，按items的顺序返回结果列表
+            items中的每一项为参数元组（非元组时作为唯一参数），kwargs对所有调用相同。
+            进行中的调用达到max_concurrency时等待，items可以是生成器；某项抛出错误后不再提交新的调用，等待已提交的完成后抛出
+        '''
+        _executor = self.GetExecutor() if executor is None else executor
+        _slots = BoundedSemaphore(max_concurrency)
+        _failed = Event()
+        def _done(future):
+            if not future.cancelled() and not future.exception() is None:
+                _failed.set()
+            _slots.release()
+        _futures = []
+        for _args in items:
+            _slots.acquire()
+            if _failed.is_set():
+                _slots.release()
+                break
+            _future = _executor.submit(self.Execute, *(_args if isinstance(_args, tuple) else (_args,)), **kwargs)
+            _future.add_done_callback(_done)
+            _futures.append(_future)
+        return [x.result() for x in _futures]
+
     def __call__(self, *args, **kwargs):
         return self.Execute(*args, **kwargs)
 
+class ExecuteMetrics(object):
+    '''
+            Execute的调用统计：调用次数、错误次数（包括被NotifyExecuteError忽略的错误）、进行中的调用数及耗时分布
+        耗时（纳秒）按2的幂分段，每段再均分为4个桶，百分位数取所在桶的上界，误差不超过25%
+        所有统计按名称（组件的LoggerName）登记在进程内，可通过SnapshotAll/ResetAll统一获取及清零
+    '''
+    REGISTRY = {}
+    REGISTRY_LOCK = Lock()
+
+    def __init__(self, name):
+        super(ExecuteMetrics, self).__init__()
+        self.Name = name
+        self.__lock = Lock()
+        self.Reset()
+
+    @staticmethod
+    def Get(name):
+        '获取指定名称的统计，不存在时创建'
+        _r = ExecuteMetrics.REGISTRY.get(name)
+        if _r is None:
+            with ExecuteMetrics.REGISTRY_LOCK:
+                _r = ExecuteMetrics.REGISTRY.setdefault(name, ExecuteMetrics(name))
+        return _r
+
+    @staticmethod
+    def SnapshotAll():
+        with ExecuteMetrics.REGISTRY_LOCK:
+            _metrics = list(ExecuteMetrics.REGISTRY.values())
+        return {x.Name: x.Snapshot() for x in _metrics}
+
+    @staticmethod
+    def ResetAll():
+        with ExecuteMetrics.REGISTRY_LOCK:
+            _metrics = list(ExecuteMetrics.REGISTRY.values())
+        for _m in _metrics:
+            _m.Reset()
+
+    def Reset(self):
+        '清零调用及错误次数、耗时分布，进行中的调用数不变'
+        with self.__lock:
+            self.Calls = 0
+            self.Errors = 0
+            self.InFlight = getattr(self, 'InFlight', 0)
+            self.TotalNs = 0
+            self.MaxNs = 0
+            self.__buckets = {}
+
+    def Enter(self):
+        '调用开始，返回开始时间'
+        with self.__lock:
+            self.InFlight += 1
+        return time.perf_counter_ns()
+
+    def Exit(self, start, failed):
+        _ns = time.perf_counter_ns() - start
+        _bucket = self._Bucket(_ns)
+        with self.__lock:
+            self.InFlight -= 1
+            self.Calls += 1
+            if failed:
+                self.Errors += 1
+            self.TotalNs += _ns
+            if _ns > self.MaxNs:
+                self.MaxNs = _ns
+            self.__buckets[_bucket] = self.__buckets.get(_bucket, 0) + 1
+
+    @staticmethod
+    def _Bucket(ns):
+        '耗时所在的桶：小于4纳秒时为耗时本身，否则高位为二进制位数，低2位为最高位之后的2位'
+        _bits = ns.bit_length()
+        return ns if _bits < 3 else (_bits << 2) | ((ns >> (_bits - 3)) & 3)
+
+    @staticmethod
+    def _BucketUpper(bucket):
+        '桶的上界（纳秒）'
+        if bucket < 4:
+            return bucket
+        _bits, _sub = bucket >> 2, bucket & 3
+        return (5 + _sub) << (_bits - 3)
+
+    def Percentile(self, percent):
+        '耗时的百分位数（纳秒）'
+        with self.__lock:
+            _buckets = sorted(self.__buckets.items())
+            _total = self.Calls
+        if _total == 0:
+            return 0
+        _target = _total * percent / 100.0
+        _count = 0
+        for _bucket, _n in _buckets:
+            _count += _n
+            if _count >= _target:
+                return min(self._BucketUpper(_bucket), self.MaxNs)
+        return self.MaxNs
+
+    def Snapshot(self):
+        '统计快照，耗时单位为微秒'
+        with self.__lock:
+            _calls, _errors, _in_flight, _total, _max = self.Calls, self.Errors, self.InFlight, self.TotalNs, self.MaxNs
+        return dict(name=self.Name, calls=_calls, errors=_errors, in_flight=_in_flight,
+                    mean_us=_total / _calls / 1000.0 if _calls else 0.0, max_us=_max / 1000.0,
+                    p50_us=self.Percentile(50) / 1000.0, p99_us=self.Percentile(99) / 1000.0)
+
+_SHARED_EXECUTOR = None
+_SHARED_EXECUTOR_LOCK = Lock()
+
+def _SharedExecutor():
+    global _SHARED_EXECUTOR
+    if _SHARED_EXECUTOR is None:
+        with _SHARED_EXECUTOR_LOCK:
+            if _SHARED_EXECUTOR is None:
+                _SHARED_EXECUTOR = ThreadPoolExecutor(max_workers=mixinExecuteable.SHARED_EXECUTOR_WORKERS, thread_name_prefix='mixinExecuteable')
+    return _SHARED_EXECUTOR
+
 #装饰器
-def TRY_CATCH_FINALLY(owner_data=None, no_raise=False, on_call=None, on_success=None, on_error=None, on_finally=None):
-    def decorator(func):
+def _TryCatchFinallyWrapper(kind, func, owner_data, no_raise, on_call, on_success, on_error, on_finally, on_timing, timing_sample):
+    '''
+            按函数类型选择包装函数，是否提供各钩子在装饰时确定为布尔值，调用时不再执行callable检查
+        kind为function、coroutine、generator或asyncgen。协程与生成器的钩子在其执行（迭代）完成时才触发
+    '''
+    _call, _success, _error, _finally, _timing = [callable(x) for x in (on_call, on_success, on_error, on_finally, on_timing)]
+    _counter = itertools.count()
+    _perf_counter = time.perf_counter
+    if kind == 'coroutine':
+        async def wrapper(*args, **kwargs):
+            _t = _perf_counter() if _timing and next(_counter) % timing_sample == 0 else None
+            if _call:
+                on_call(owner_data)
+            try:
+                _r = await func(*args, **kwargs)
+                if _success:
+                    on_success(owner_data)
+                return _r
+            except Exception:
+                if _error:
+                    on_error(owner_data)
+                if not no_raise:
+                    raise
+            finally:
+                if _finally:
+                    on_finally(owner_data)
+                if not _t is None:
+                    on_timing(owner_data, _perf_counter() - _t)
+    elif kind == 'generator':
+        def wrapper(*args, **kwargs):
+            _t = _perf_counter() if _timing and next(_counter) % timing_sample == 0 else None
+            if _call:
+                on_call(owner_data)
+            try:
+                _r = yield from func(*args, **kwargs)
+                if _success:
+                    on_success(owner_data)
+                return _r
+            except Exception:
+                if _error:
+                    on_error(owner_data)
+                if not no_raise:
+                    raise
+            finally:
+                if _finally:
+                    on_finally(owner_data)
+                if not _t is None:
+                    on_timing(owner_data, _perf_counter() - _t)
+    elif kind == 'asyncgen':
+        async def wrapper(*args, **kwargs):
+            _t = _perf_counter() if _timing and next(_counter) % timing_sample == 0 else None
+            if _call:
+                on_call(owner_data)
+            try:
+                async for _r in func(*args, **kwargs):
+                    yield _r
+                if _success:
+                    on_success(owner_data)
+            except Exception:
+                if _error:
+                    on_error(owner_data)
+                if not no_raise:
+                    raise
+            finally:
+                if _finally:
+                    on_finally(owner_data)
+                if not _t is None:
+                    on_timing(owner_data, _perf_counter() - _t)
+    else:
         def wrapper(*args, **kwargs):
-            if callable(on_call):
+            _t = _perf_counter() if _timing and next(_counter) % timing_sample == 0 else None
+            if _call:
                 on_call(owner_data)
             try:
                 _r = func(*args, **kwargs)
-                if callable(on_success):
+                if _success:
                     on_success(owner_data)
                 return _r
-            except Exception as _e:
-                if callable(on_error):
+            except Exception:
+                if _error:
                     on_error(owner_data)
                 if not no_raise:
                     raise
             finally:
-                if callable(on_finally):
+                if _finally:
                     on_finally(owner_data)
-        return wrapper
+                if not _t is None:
+                    on_timing(owner_data, _perf_counter() - _t)
+    return wrapper
+
+def TRY_CATCH_FINALLY(owner_data=None, no_raise=False, on_call=None, on_success=None, on_error=None, on_finally=None, on_timing=None, timing_sample=1):
+    '''
+            为函数增加调用前、成功、出错、结束时的钩子，钩子的参数为owner_data
+        包装函数在装饰时按函数类型选定，是否提供各钩子预先确定，调用时不再逐一检查callable，并保留原函数的名称、文档等属性；未提供任何钩子时直接返回原函数
+        支持async def、生成器及异步生成器函数，钩子在协程执行完成或生成器迭代结束时触发
+        on_timing(owner_data, seconds)每timing_sample次调用采样一次耗时
+    '''
+    def decorator(func):
+        if not (callable(on_call) or callable(on_success) or callable(on_error) or no_raise or callable(on_finally) or callable(on_timing)):
+            return func
+        if inspect.isasyncgenfunction(func):
+            _kind = 'asyncgen'
+        elif inspect.iscoroutinefunction(func):
+            _kind = 'coroutine'
+        elif inspect.isgeneratorfunction(func):
+            _kind = 'generator'
+        else:
+            _kind = 'function'
+        _wrapper = _TryCatchFinallyWrapper(_kind, func, owner_data, no_raise, on_call, on_success, on_error, on_finally, on_timing, max(int(timing_sample), 1))
+        return functools.wraps(func)(_wrapper)
     return decorator
             
-def API_RESULT(serializer=None):
+def API_RESULT(serializer=None, encoded=False, stream=False, chunk_size=65536):
+    '''
+            将函数返回值封装为{"result":"success","value":...}，出错时result为错误描述
+        encoded为True时直接返回UTF-8编码的bytes：信封与值一起在一次编码中完成（有serializer时使用其DumpedToString，过滤器对整个信封生效），调用方无需再次json编码
+        stream为True时返回bytes块的生成器。函数返回迭代器（如生成器）时逐项编码，先输出'{"result":"success","value":['，
+            每累积chunk_size字节输出一块，迭代结束后输出']}'；迭代中出错时关闭数组并追加"error"键。
+            逐项编码时serializer的dumper过滤器（如DumpedZipper）不生效；非迭代器返回值作为一整块输出
+    '''
+    def _Error(e):
+        return '<{e_cls}>: {e_msg}'.format(e_cls=e.__class__.__name__, e_msg=str(e))
+    def _Encode(data):
+        if serializer is None:
+            return json.dumps(data, ensure_ascii=False).encode('utf8')
+        _r = serializer.DumpedToString(data)
+        return _r.encode('utf8') if isinstance(_r, str) else _r
+    def _Stream(items):
+        _chunk = bytearray(b'{"result":"success","value":[')
+        #首块立即输出，使客户端在结果完全生成前就能收到响应
+        yield bytes(_chunk)
+        _chunk.clear()
+        _sep = b''
+        try:
+            for _item in items:
+                if not serializer is None:
+                    _item = serializer.Dump(_item)
+                #先完成编码，编码失败时不留下多余的分隔符
+                _encoded = json.dumps(_item, ensure_ascii=False).encode('utf8')
+                _chunk += _sep
+                _chunk += _encoded
+                _sep = b','
+                if len(_chunk) >= chunk_size:
+                    yield bytes(_chunk)
+                    _chunk.clear()
+        except Exception as _e:
+            _chunk += b'],"error":' + json.dumps(_Error(_e), ensure_ascii=False).encode('utf8') + b'}'
+        else:
+            _chunk += b']}'
+        yield bytes(_chunk)
     def decorator(func):
         def wrapper(*args, **kwargs):
             try:
                 _r = func(*args, **kwargs)
+                if stream and hasattr(_r, '__next__'):
+                    return _Stream(_r)
                 #确保_r中的数据可以被json序列化
                 if not serializer is None:
                     _r = serializer.Dump(_r)
-                return dict(result='success', value=_r)
+                _r = dict(result='success', value=_r)
+                #编码错误（如值不能被json序列化）同样以错误信封返回
+                if encoded or stream:
+                    _r = _Encode(_r)
             except Exception as _e:
-                return dict(result='<{e_cls}>: {e_msg}'.format(e_cls=_e.__class__.__name__, e_msg=str(_e)))
-                raise
+                _r = dict(result=_Error(_e))
+                if encoded or stream:
+                    _r = _Encode(_r)
+            return iter([_r]) if stream else _r
         return wrapper
     return decorator
                 
@@ -238,13 +652,120 @@ def DEFAULT_ERROR_MESSAGE():
         exception_message=sys.exc_info()[1])
 
     
+class Reference(object):
+    '''
+            路径引用
+        path形如"name/key/..."：name为registry中的注册名，其后各段依次按dict键、列表下标或属性名取值。
+        取得的值仍是Reference时继续解析直至最终值，解析链中同一引用再次出现时抛出ReferenceCycleError，找不到时抛出NotFoundError
+        解析结果与所经过各registry的Revision一起缓存，任一registry发生注册、删除后重新解析；注册项内部的修改不会使缓存失效
+    '''
+    SEPARATOR = '/'
+    #未指定registry时使用的注册库
+    REGISTRY = None
+
+    def __init__(self, path, registry=None):
+        super(Reference, self).__init__()
+        self.Path = path
+        self.Registry = registry
+        self.__cache = None             #(((registry, revision), ...), value)
+
+    def Invalidate(self):
+        self.__cache = None
+
+    @staticmethod
+    def _Step(value, key):
+        '按路径中的一段取值'
+        if isinstance(value, dict):
+            if key in value:
+                return value[key]
+        elif isinstance(value, (list, tuple)):
+            try:
+                return value[int(key)]
+            except (ValueError, IndexError):
+                pass
+        elif hasattr(value, key):
+            return getattr(value, key)
+        raise NotFoundError('"%s" not found' % key)
+
+    def Resolve(self):
+        '解析得到最终值'
+        _cache = self.__cache
+        if not _cache is None:
+            for _registry, _revision in _cache[0]:
+                if _registry.Revision != _revision:
+                    break
+            else:
+                return _cache[1]
+        _value = self
+        _rest = ()
+        _seen = set()
+        _revisions = []
+        while True:
+            if isinstance(_value, Reference):
+                _registry = Reference.REGISTRY if _value.Registry is None else _value.Registry
+                if _registry is None:
+                    raise NotFoundError('no registry for reference "%s"' % _value.Path)
+                _key = (id(_registry), _value.Path)
+                if _key in _seen:
+                    raise ReferenceCycleError('reference cycle at "%s"' % _value.Path)
+                _seen.add(_key)
+                #先记录版本号再取值，取值期间发生的变更会使下次解析重新进行
+                _revisions.append((_registry, _registry.Revision))
+                _parts = _value.Path.split(_value.SEPARATOR)
+                _rest = tuple(_parts[1:]) + _rest
+                _value = _registry.Get(_parts[0], default=_UNSET)
+                if _value is _UNSET:
+                    raise NotFoundError('"%s" not found' % _parts[0])
+            elif _rest:
+                _value = self._Step(_value, _rest[0])
+                _rest = _rest[1:]
+            else:
+                break
+        self.__cache = (tuple(_revisions), _value)
+        return _value
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.Path)
+
 def VALUE(value):
     '''
             获取变量的值。
-        在组件式的结构中，变量可能会使用Refrence对象来实现路径引用，以满足运行时的组件动态装配，此时直接访问变量得到的是Refrence对象，而不是真实的值，所以需要遍历的方式得到最终值返回
+        在组件式的结构中，变量可能会使用Reference对象来实现路径引用，以满足运行时的组件动态装配，此时直接访问变量得到的是Reference对象，而不是真实的值，所以需要遍历的方式得到最终值返回
     '''
-    #TODO:    返回值应该是循环遍历最终得到的值
-    return value() if callable(value) else value
+    if callable(value) and not isinstance(value, Reference):
+        value = value()
+    return value.Resolve() if isinstance(value, Reference) else value
+
+_ATTACH_LOCK = Lock()
+#当前线程正在打开已存在的段，此期间跳过resource_tracker登记
+_ATTACHING = local()
+
+def _TrackerRegister(register):
+    '替换resource_tracker.register，只跳过ATTACH_SHARED_MEMORY所在线程的登记，其他线程创建的段照常登记'
+    def wrapper(name, rtype):
+        if not getattr(_ATTACHING, 'Active', False):
+            register(name, rtype)
+    wrapper._Attaching = True
+    return wrapper
+
+def ATTACH_SHARED_MEMORY(name):
+    '''
+            打开已存在的共享内存段（由其他进程或本进程的其他对象创建）
+        附加方不能登记到resource_tracker，否则进程退出时段会被删除；登记后再注销又会注销掉同一tracker中创建方的登记。
+        Python 3.13以下没有track参数，首次调用时以只对本线程生效的版本替换resource_tracker.register
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    with _ATTACH_LOCK:
+        if not getattr(resource_tracker.register, '_Attaching', False):
+            resource_tracker.register = _TrackerRegister(resource_tracker.register)
+    _ATTACHING.Active = True
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        _ATTACHING.Active = False
 
 def URL2DICT(url):
     '''
@@ -275,23 +796,184 @@ class LoggingByRabbitMQ(object):
         def __init__(self, publisher):
             super().__init__()
             self.Publisher = publisher
+            #asctime使用默认格式，所有记录共用一个Formatter
+            self._TimeFormatter = logging.Formatter()
             self.Fields = None
+
+        @property
+        def Fields(self):
+            '需要发送的记录属性，None时发送全部属性'
+            return self.__fields
+        @Fields.setter
+        def Fields(self, value):
+            self.__fields = value
+            self.__extract = LoggingByRabbitMQ.CompileExtractor(value)
             
-        def emit(self, record):
-            _fields = self.Fields if not self.Fields is None else [x for  x in record.__dict__.keys()]
-            _pack = {}
-            for _name in _fields:
-                if hasattr(record, _name):
-                    _pack[_name] = str(getattr(record, _name, 'NULL'))
+        def Pack(self, record):
+            '将记录整理为dict'
+            _pack = self.__extract(record.__dict__)
             #格式化后的字符串作为message存储
             _pack['message'] = str(self.format(record))
-            _pack['asctime'] = logging.Formatter().formatTime(record)
-            self.Publisher.Execute(json.dumps(_pack))
+            _pack['asctime'] = self._TimeFormatter.formatTime(record)
+            return _pack
+
+        def emit(self, record):
+            self.Publisher.Execute(json.dumps(self.Pack(record)))
+
+    class BatchHandler(Handler):
+        '''
+                非阻塞的批量日志处理器
+            emit只在调用线程中整理记录并放入有界缓冲，由后台线程批量发布：缓冲中达到batch_size条或等待flush_interval秒后，
+            以JSON数组的形式调用一次Publisher.Execute，接收方可使用RecordMessages解析
+            缓冲达到max_buffer条时按overflow处理：block等待，drop_oldest丢弃最早的记录，drop_newest丢弃当前记录
+            Dropped为丢弃的记录数，Published为已发布的记录数，PublishErrors为发布失败的批次数（失败的批次被丢弃）
+            encoding为json时每批是记录dict的数组；为columnar时为{"fields":[...], "rows":[[...], ...]}，属性名只出现一次。
+            compress为True时经SerializerForJSON的DumpedZipper过滤器压缩为bytes（记录中只有字符串，无需经过Dump）
+        '''
+        OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+        ENCODINGS = ('json', 'columnar')
+
+        def __init__(self, publisher, batch_size=100, flush_interval=1.0, max_buffer=10000, overflow='block', encoding='json', compress=False):
+            super().__init__(publisher)
+            if not overflow in self.OVERFLOW_POLICIES:
+                raise ValueError('unknown overflow policy "%s"' % overflow)
+            if not encoding in self.ENCODINGS:
+                raise ValueError('unknown encoding "%s"' % encoding)
+            self.Encoding = encoding
+            self.__serializer = None
+            if compress:
+                from pcs_base.serializer import SerializerForJSON, DumpedZipper
+                self.__serializer = SerializerForJSON(filters=[DumpedZipper])
+            self.BatchSize = batch_size
+            self.FlushInterval = flush_interval
+            self.MaxBuffer = max_buffer
+            self.Overflow = overflow
+            self.Dropped = 0
+            self.Published = 0
+            self.PublishErrors = 0
+            self.__buffer = collections.deque()
+            self.__cond = Condition()
+            self.__closed = False
+            #正在等待flush的调用数，以及后台线程是否正在发布
+            self.__flushing = 0
+            self.__publishing = False
+            self.__thread = Thread(target=self.__Run, name='LoggingByRabbitMQ.BatchHandler', daemon=True)
+            self.__thread.start()
+
+        def emit(self, record):
+            try:
+                _pack = self.Pack(record)
+            except Exception:
+                self.handleError(record)
+                return
+            with self.__cond:
+                #close()之后刷新线程已退出，追加的记录不会再被发布
+                if self.__closed:
+                    self.Dropped += 1
+                    return
+                while len(self.__buffer) >= self.MaxBuffer:
+                    if self.__closed or self.Overflow == 'drop_newest':
+                        self.Dropped += 1
+                        return
+                    if self.Overflow == 'drop_oldest':
+                        self.__buffer.popleft()
+                        self.Dropped += 1
+                        break
+                    self.__cond.wait()
+                self.__buffer.append(_pack)
+                if len(self.__buffer) >= self.BatchSize:
+                    self.__cond.notify_all()
+
+        def Encode(self, batch):
+            '按encoding及compress编码一批记录'
+            if self.Encoding == 'columnar':
+                batch = LoggingByRabbitMQ.ToColumnar(batch)
+            if self.__serializer is None:
+                return json.dumps(batch)
+            return self.__serializer.DumpedToString(batch)
+
+        def Publish(self, batch):
+            '发布一批记录'
+            self.Publisher.Execute(self.Encode(batch))
+
+        def __Run(self):
+            while True:
+                with self.__cond:
+                    if len(self.__buffer) < self.BatchSize and not self.__closed and self.__flushing == 0:
+                        self.__cond.wait(self.FlushInterval)
+                    _batch = [self.__buffer.popleft() for _ in range(min(self.BatchSize, len(self.__buffer)))]
+                    if not _batch and self.__closed:
+                        return
+                    self.__publishing = len(_batch) > 0
+                    #唤醒因缓冲已满而等待的emit
+                    self.__cond.notify_all()
+                if _batch:
+                    try:
+                        self.Publish(_batch)
+                        self.Published += len(_batch)
+                    except Exception:
+                        self.PublishErrors += 1
+                    finally:
+                        with self.__cond:
+                            self.__publishing = False
+                            self.__cond.notify_all()
+
+        def flush(self):
+            '等待缓冲中的记录全部发布'
+            with self.__cond:
+                if not self.__thread.is_alive():
+                    return
+                self.__flushing += 1
+                self.__cond.notify_all()
+                try:
+                    while self.__buffer or self.__publishing:
+                        self.__cond.wait()
+                finally:
+                    self.__flushing -= 1
+
+        def close(self):
+            '发布缓冲中剩余的记录后停止后台线程'
+            with self.__cond:
+                self.__closed = True
+                self.__cond.notify_all()
+            self.__thread.join()
+            super().close()
             
     @staticmethod        
     def RecordMessage(data):
         '返回格式化后的字符串。data中也包含了其他信息：name, msg, args, levelname, levelno, pathname, filename, module, exc_info, exc_text, stack_info, lineno, funcName, created, msecs, relativeCreated, thread, threadName, processName, process, message'
         return data.get('message')
+
+    @staticmethod
+    def RecordMessages(data):
+        '返回一批记录中各条格式化后的字符串。data为BatchHandler发布的数据（可以是未解码的）或单条记录'
+        return [x.get('message') for x in LoggingByRabbitMQ.DecodeBatch(data)]
+
+    @staticmethod
+    def DecodeBatch(data):
+        '将BatchHandler发布的数据（任一encoding，是否压缩均可）解码为记录dict的列表'
+        if isinstance(data, bytes) and data[:4] == b'ZIP!':
+            data = zlib.decompress(data[4:])
+        if isinstance(data, (str, bytes)):
+            data = json.loads(data)
+        if isinstance(data, dict) and 'fields' in data and 'rows' in data:
+            _fields = data['fields']
+            return [{_k: _v for _k, _v in zip(_fields, _row) if not _v is None} for _row in data['rows']]
+        return data if isinstance(data, list) else [data]
+
+    @staticmethod
+    def ToColumnar(batch):
+        '将记录dict的列表转换为列式结构，缺少的属性为None'
+        _fields = list(dict.fromkeys(_k for _pack in batch for _k in _pack))
+        return dict(fields=_fields, rows=[[_pack.get(_k) for _k in _fields] for _pack in batch])
+
+    @staticmethod
+    def CompileExtractor(fields):
+        '生成从record.__dict__中取出fields并转为字符串的函数，fields为None时取出全部属性'
+        if fields is None:
+            return lambda d: {_k: str(_v) for _k, _v in d.items()}
+        _fields = tuple(fields)
+        return lambda d: {_k: str(d[_k]) for _k in _fields if _k in d}
     
 ############################
 ###########################
@@ -354,5 +1036,312 @@ def test_TRY_CATCH_FINALLY():
     print(_a.function_7(a=1,b=2))
     print(_a.function_8(a=1,b=2))
 
+def test_TRY_CATCH_FINALLY_kinds():
+    import asyncio
+    _events = []
+    _hooks = dict(on_call=lambda od: _events.append('call'), on_success=lambda od: _events.append('success'),
+                  on_error=lambda od: _events.append('error'), on_finally=lambda od: _events.append('finally'),
+                  on_timing=lambda od, t: _events.append('timing'))
+    @TRY_CATCH_FINALLY(**_hooks)
+    async def function_async(x):
+        await asyncio.sleep(0)
+        _events.append('run')
+        return x
+    @TRY_CATCH_FINALLY(no_raise=True, **_hooks)
+    def function_gen(n):
+        for _i in range(n):
+            _events.append('run')
+            yield _i
+        raise ValueError
+    @TRY_CATCH_FINALLY(**_hooks)
+    async def function_asyncgen(n):
+        for _i in range(n):
+            yield _i
+    assert function_async.__name__ == 'function_async'
+    assert asyncio.run(function_async(1)) == 1
+    print(_events)
+    assert _events == ['call', 'run', 'success', 'finally', 'timing']
+    _events.clear()
+    assert list(function_gen(2)) == [0, 1]
+    print(_events)
+    assert _events == ['call', 'run', 'run', 'error', 'finally', 'timing']
+    async def _collect():
+        return [x async for x in function_asyncgen(3)]
+    assert asyncio.run(_collect()) == [0, 1, 2]
+
+def benchmark_TRY_CATCH_FINALLY(count=1000000):
+    '包装函数的额外耗时'
+    import timeit
+    def _legacy(owner_data=None, no_raise=False, on_call=None, on_success=None, on_error=None, on_finally=None):
+        '原实现：每次调用检查全部钩子'
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                if callable(on_call):
+                    on_call(owner_data)
+                try:
+                    _r = func(*args, **kwargs)
+                    if callable(on_success):
+                        on_success(owner_data)
+                    return _r
+                except Exception:
+                    if callable(on_error):
+                        on_error(owner_data)
+                    if not no_raise:
+                        raise
+                finally:
+                    if callable(on_finally):
+                        on_finally(owner_data)
+            return wrapper
+        return decorator
+    def _func(x):
+        return x
+    _noop = lambda od: None
+    for _name, _func_wrapped in [('bare', _func), ('legacy()', _legacy()(_func)), ('legacy(finally)', _legacy(on_finally=_noop)(_func)),
+                                 ('TCF()', TRY_CATCH_FINALLY()(_func)), ('TCF(finally)', TRY_CATCH_FINALLY(on_finally=_noop)(_func)),
+                                 ('TCF(timing/100)', TRY_CATCH_FINALLY(on_timing=lambda od, t: None, timing_sample=100)(_func))]:
+        print('%-20s%8.3f us' % (_name, timeit.timeit(lambda: _func_wrapped(1), number=count) / count * 1e6))
+
+def test_Reference():
+    from pcs_base.key_value import Registry
+    _registry = Registry()
+    Reference.REGISTRY = _registry
+    _registry.RegisterMany(dict(db=dict(url='amqp://host', hosts=['a', 'b']), alias=Reference('db/hosts'), last=Reference('alias/1'),
+                                loop1=Reference('loop2'), loop2=Reference('loop1')))
+    _last = Reference('last')
+    print(VALUE(_last), VALUE(lambda: Reference('db/url')), VALUE(3))
+    assert VALUE(_last) == 'b'
+    _registry._Set('db', dict(hosts=['c', 'd']))
+    assert VALUE(_last) == 'd'
+    for _ref, _error in [(Reference('loop1'), ReferenceCycleError), (Reference('db/none'), NotFoundError), (Reference('none'), NotFoundError)]:
+        try:
+            _ref.Resolve()
+            assert False
+        except _error as _e:
+            print(_error.__name__, _e)
+    import timeit
+    print('Resolve(cached) %.3f us' % (timeit.timeit(_last.Resolve, number=100000) * 10))
+    Reference.REGISTRY = None
+
+def test_API_RESULT():
+    @API_RESULT()
+    def function_list(n):
+        return list(range(n))
+    @API_RESULT(encoded=True)
+    def function_encoded(n):
+        return dict(n=n, name='中文')
+    @API_RESULT(stream=True, chunk_size=16)
+    def function_stream(n, fail_at=None):
+        for _i in range(n):
+            if _i == fail_at:
+                raise ValueError('fail at %d' % _i)
+            yield dict(i=_i)
+    print(function_list(3))
+    print(function_encoded(3))
+    _chunks = list(function_stream(5))
+    print(_chunks)
+    assert json.loads(b''.join(_chunks)) == dict(result='success', value=[dict(i=_i) for _i in range(5)])
+    _r = json.loads(b''.join(function_stream(5, fail_at=3)))
+    print(_r)
+    assert _r['value'] == [dict(i=0), dict(i=1), dict(i=2)] and 'error' in _r
+    #不能被json编码的项
+    import datetime
+    @API_RESULT(stream=True)
+    def function_unencodable():
+        yield 1
+        yield datetime.datetime.now()
+    _r = json.loads(b''.join(function_unencodable()))
+    assert _r['value'] == [1] and _r['error'].startswith('<TypeError>')
+
+class _Doubler(mixinCommon, mixinExecuteable):
+    '供test_mixinExecuteable使用。进程池中执行时实例须可被pickle，因此定义在模块级'
+    def DoExecute(self, x):
+        if x < 0:
+            raise ValueError(x)
+        return x * 2
+
+def test_mixinExecuteable():
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+    _events = []
+    _c = _Doubler()
+    _c.NotifyBeforeExecute = lambda sender, args, kwargs: _events.append(('before', args))
+    _c.NotifyExecuteSuccess = lambda sender, args, kwargs: _events.append(('success', args))
+    #-1的错误被忽略
+    _c.NotifyExecuteError = lambda sender, args, kwargs, error: _events.append(('error', args)) or args[0] == -1
+    _c.NotifyAfterExecute = lambda sender, args, kwargs: _events.append(('after', args))
+    assert _c.Execute(2) == 4
+    assert _events == [('before', (2,)), ('success', (2,)), ('after', (2,))]
+    del _events[:]
+    assert _c.Execute(-1) is None
+    assert _events == [('before', (-1,)), ('error', (-1,)), ('after', (-1,))]
+    try:
+        _c.Execute(-2)
+        assert False
+    except ValueError:
+        pass
+
+    class _Async(_Doubler):
+        async def DoExecute(self, x):
+            await asyncio.sleep(0)
+            _events.append(('done', (x,)))
+            return super(_Async, self).DoExecute(x)
+    _a = _Async()
+    for _name in ['NotifyBeforeExecute', 'NotifyExecuteSuccess', 'NotifyExecuteError', 'NotifyAfterExecute']:
+        setattr(_a, _name, getattr(_c, _name))
+    del _events[:]
+    assert asyncio.run(_a.ExecuteAsync(3)) == 6
+    assert asyncio.run(_a.ExecuteAsync(-1)) is None
+    assert _events == [('before', (3,)), ('done', (3,)), ('success', (3,)), ('after', (3,)),
+                       ('before', (-1,)), ('done', (-1,)), ('error', (-1,)), ('after', (-1,))]
+
+    _d = _Doubler()
+    assert _d.Submit(5).result() == 10
+    assert _d.ExecuteMany(range(10), max_concurrency=3) == [x * 2 for x in range(10)]
+    assert _d.ExecuteMany([(1,), 2]) == [2, 4]
+    #出错后不再提交新的调用
+    _consumed = []
+    def _items():
+        for _i in [0, 1, 2, -3, 4, 5, 6, 7]:
+            _consumed.append(_i)
+            yield _i
+    try:
+        _d.ExecuteMany(_items(), max_concurrency=1)
+        assert False
+    except ValueError:
+        pass
+    assert _consumed == [0, 1, 2, -3, 4]
+
+    #实例及Metrics、EXECUTOR中的锁不会被pickle到子进程
+    with ProcessPoolExecutor(2) as _pool:
+        _d.EXECUTOR = _pool
+        _d.EnableMetrics()
+        assert _d.Submit(4).result() == 8
+        assert _d.ExecuteMany(range(5)) == [0, 2, 4, 6, 8]
+    _d.EnableMetrics(False)
+
+def test_ExecuteMetrics():
+    for _ns in list(range(1, 5000)) + [10**_e + _d for _e in range(4, 12) for _d in (-1, 0, 1)]:
+        _upper = ExecuteMetrics._BucketUpper(ExecuteMetrics._Bucket(_ns))
+        assert _ns <= _upper <= _ns * 1.25, _ns
+    _m = ExecuteMetrics.Get('test_ExecuteMetrics')
+    _m.Reset()
+    #1..100毫秒各一次，其中10次失败
+    _now = time.perf_counter_ns()
+    for _ms in range(1, 101):
+        _m.Enter()
+        _m.Exit(_now - _ms * 1000000, _ms % 10 == 0)
+    _ms = lambda ns: ns / 1000000.0
+    assert 50 <= _ms(_m.Percentile(50)) <= 62.5 and 99 <= _ms(_m.Percentile(99)) <= _ms(_m.MaxNs) < 101
+    _snapshot = ExecuteMetrics.SnapshotAll()['test_ExecuteMetrics']
+    assert (_snapshot['calls'], _snapshot['errors'], _snapshot['in_flight']) == (100, 10, 0)
+    assert 50.5 <= _snapshot['mean_us'] / 1000 < 51.5 and _snapshot['p50_us'] == _m.Percentile(50) / 1000.0
+    ExecuteMetrics.ResetAll()
+    assert _m.Snapshot()['calls'] == 0 and _m.Percentile(99) == 0
+
+    #LoggerName变化后计入新名称
+    _c = _Doubler()
+    _c.LoggerName = 'test_ExecuteMetrics'
+    _c.EnableMetrics()
+    _c.Execute(1)
+    _c.LoggerName = 'test_ExecuteMetrics_renamed'
+    _c.Execute(2)
+    assert _m.Calls == 1 and ExecuteMetrics.Get('test_ExecuteMetrics_renamed').Calls == 1
+    _c.EnableMetrics(False)
+    with ExecuteMetrics.REGISTRY_LOCK:
+        for _name in ['test_ExecuteMetrics', 'test_ExecuteMetrics_renamed']:
+            del ExecuteMetrics.REGISTRY[_name]
+
+def benchmark_mixinExecuteable(count=200000):
+    '属性读写及Execute调用的耗时'
+    import timeit
+    class _Component(mixinCommon, mixinExecuteable):
+        def DoExecute(self, x):
+            return x
+    _c = _Component()
+    _c.NotifyPropertyChanged = lambda sender, name: None
+    _c.NotifyAfterExecute = lambda sender, args, kwargs: None
+    for _name, _stmt in [('Enabled(read)', lambda: _c.Enabled), ('LoggerName(read)', lambda: _c.LoggerName),
+                         ('Enabled(write)', lambda: setattr(_c, 'Enabled', not _c.Enabled)), ('Execute', lambda: _c.Execute(1))]:
+        print('%-20s%8.3f us' % (_name, timeit.timeit(_stmt, number=count) / count * 1e6))
+    _c.EnableMetrics()
+    print('%-20s%8.3f us' % ('Execute(metrics)', timeit.timeit(lambda: _c.Execute(1), number=count) / count * 1e6))
+    _c.EnableMetrics(False)
+
+def test_LoggingByRabbitMQ():
+    class _Publisher(object):
+        def __init__(self, delay=0):
+            self.Batches = []
+            self.Delay = delay
+        def Execute(self, data):
+            time.sleep(self.Delay)
+            self.Batches.append(json.loads(data))
+    _logger = logging.getLogger('test_LoggingByRabbitMQ')
+    _logger.propagate = False
+    for _overflow in LoggingByRabbitMQ.BatchHandler.OVERFLOW_POLICIES:
+        _publisher = _Publisher(delay=0.01)
+        _handler = LoggingByRabbitMQ.BatchHandler(_publisher, batch_size=10, flush_interval=0.1, max_buffer=50, overflow=_overflow)
+        _handler.Fields = ['levelname', 'name']
+        _logger.addHandler(_handler)
+        _start = time.perf_counter()
+        for _i in range(1000):
+            _logger.warning('message %d', _i)
+        _elapsed = time.perf_counter() - _start
+        _handler.flush()
+        _logger.removeHandler(_handler)
+        _handler.close()
+        _messages = [y for x in _publisher.Batches for y in LoggingByRabbitMQ.RecordMessages(x)]
+        print(_overflow, 'emit %.1f ms' % (_elapsed * 1000), 'published', _handler.Published, 'dropped', _handler.Dropped, 'batches', len(_publisher.Batches), 'last', _messages[-1])
+        assert _handler.Published + _handler.Dropped == 1000
+
+def benchmark_LoggingByRabbitMQ(count=20000):
+    '对比原emit（逐条JSON）与各种批量编码的吞吐及数据量'
+    class _Publisher(object):
+        def __init__(self):
+            self.Bytes = 0
+        def Execute(self, data):
+            self.Bytes += len(data)
+    def _legacy_emit(handler, record):
+        _fields = handler.Fields if not handler.Fields is None else [x for  x in record.__dict__.keys()]
+        _pack = {}
+        for _name in _fields:
+            if hasattr(record, _name):
+                _pack[_name] = str(getattr(record, _name, 'NULL'))
+        _pack['message'] = str(handler.format(record))
+        _pack['asctime'] = logging.Formatter().formatTime(record)
+        handler.Publisher.Execute(json.dumps(_pack))
+    _records = [logging.LogRecord('benchmark', logging.INFO, __file__, _i, 'message %d', (_i,), None) for _i in range(count)]
+    for _fields in [None, ['name', 'levelname', 'lineno', 'created']]:
+        _publisher = _Publisher()
+        _handler = LoggingByRabbitMQ.Handler(_publisher)
+        _handler.Fields = _fields
+        _start = time.perf_counter()
+        for _record in _records:
+            _legacy_emit(_handler, _record)
+        print('fields=%-5s %-22s%10.0f records/s%10d bytes' % (_fields is not None, 'legacy emit', count / (time.perf_counter() - _start), _publisher.Bytes))
+        _publisher = _Publisher()
+        _handler.Publisher = _publisher
+        _start = time.perf_counter()
+        for _record in _records:
+            _handler.emit(_record)
+        print('fields=%-5s %-22s%10.0f records/s%10d bytes' % (_fields is not None, 'emit', count / (time.perf_counter() - _start), _publisher.Bytes))
+        for _encoding in LoggingByRabbitMQ.BatchHandler.ENCODINGS:
+            for _compress in (False, True):
+                _publisher = _Publisher()
+                _handler = LoggingByRabbitMQ.BatchHandler(_publisher, batch_size=500, max_buffer=count, encoding=_encoding, compress=_compress)
+                _handler.Fields = _fields
+                _start = time.perf_counter()
+                for _record in _records:
+                    _handler.emit(_record)
+                _handler.flush()
+                print('fields=%-5s %-22s%10.0f records/s%10d bytes' % (_fields is not None, 'batch %s%s' % (_encoding, '+zip' if _compress else ''), count / (time.perf_counter() - _start), _publisher.Bytes))
+                _handler.close()
+
 if __name__ == '__main__':
+    test_LoggingByRabbitMQ()
+    test_mixinExecuteable()
+    test_ExecuteMetrics()
+    benchmark_mixinExecuteable()
+    test_API_RESULT()
+    test_TRY_CATCH_FINALLY_kinds()
+    benchmark_TRY_CATCH_FINALLY()
     test_TRY_CATCH_FINALLY()
\ No newline at end of file
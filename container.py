@@ -0,0 +1,450 @@
+#coding: utf-8
+'''
+Created on 2026年10月19日
+
+分块压缩的索引容器文件
+
+DumpedZipper的结果是单一zlib流，读取其中任何一部分都要解压全部数据。本容器将记录分组为独立压缩的块：
+    文件头    <4sB3x>     'ZCK!'，版本
+    块        <4sII>      'CHK!'，压缩数据长度，记录数；其后为zlib压缩的记录序列，每条记录为<II>键长度、数据长度，键，数据
+    索引      每块一项    <QIIQHH>块偏移、压缩数据长度、记录数、首条记录序号、最小键长度、最大键长度，最小键，最大键
+    文件尾    <QQ4s>      索引偏移，索引长度，'ZCK$'
+
+按键或记录序号访问时根据索引只解压所需的块；全量扫描时各块可在多个进程中并行解压。
+追加写入时新块写在原文件尾之后，Close时再写入包含全部块的新索引及文件尾，已有的块不会被重写。
+新的文件尾写入之前原索引一直有效：读端在文件末尾没有有效的文件尾时，使用此前最后一个有效的文件尾，即上次完成写入时的内容。
+被取代的索引及文件尾留在文件中（每块数十字节）。写入中断后可用ChunkedWriter.Recover按块头重建包含全部完整块的索引。
+
+键和数据均为bytes，键为str时按UTF-8编码，编码后的键不能超过65535字节。同一个键多次写入时，按键读取得到最后写入的数据
+'''
+import os
+import mmap
+import zlib
+import struct
+import bisect
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+_HEADER = struct.Struct('<4sB3x')
+_MAGIC = b'ZCK!'
+_VERSION = 1
+_CHUNK = struct.Struct('<4sII')
+_CHUNK_MAGIC = b'CHK!'
+_RECORD = struct.Struct('<II')
+_INDEX = struct.Struct('<QIIQHH')
+_FOOTER = struct.Struct('<QQ4s')
+_FOOTER_MAGIC = b'ZCK$'
+
+def _Key(key):
+    return key.encode('utf8') if isinstance(key, str) else bytes(key)
+
+def _ParseRecords(raw):
+    '将解压后的块数据解析为[(key, data), ...]'
+    _r = []
+    _offset = 0
+    _view = memoryview(raw)
+    while _offset < len(raw):
+        _key_len, _data_len = _RECORD.unpack_from(raw, _offset)
+        _offset += _RECORD.size
+        _r.append((bytes(_view[_offset:_offset+_key_len]), bytes(_view[_offset+_key_len:_offset+_key_len+_data_len])))
+        _offset += _key_len + _data_len
+    return _r
+
+def _DecodeChunk(filename, offset, length, func=None):
+    '在工作进程中读取并解压一个块。func不为None时返回[func(key, data), ...]'
+    with open(filename, 'rb') as _f:
+        _f.seek(offset + _CHUNK.size)
+        _records = _ParseRecords(zlib.decompress(_f.read(length)))
+    return _records if func is None else [func(_k, _d) for _k, _d in _records]
+
+def _PackIndex(index):
+    _r = bytearray()
+    for _offset, _length, _count, _first, _min, _max in index:
+        _r += _INDEX.pack(_offset, _length, _count, _first, len(_min), len(_max)) + _min + _max
+    return bytes(_r)
+
+def _UnpackIndex(data):
+    _r = []
+    _offset = 0
+    while _offset < len(data):
+        _chunk_offset, _length, _count, _first, _min_len, _max_len = _INDEX.unpack_from(data, _offset)
+        _offset += _INDEX.size
+        _min = bytes(data[_offset:_offset+_min_len])
+        _max = bytes(data[_offset+_min_len:_offset+_min_len+_max_len])
+        _offset += _min_len + _max_len
+        _r.append((_chunk_offset, _length, _count, _first, _min, _max))
+    return _r
+
+def _FindFooter(f, size):
+    '''
+            从文件末尾向前查找最后一个有效的文件尾，返回(索引偏移, 索引长度, 文件尾结束位置)，不存在时返回None
+        正常情况下文件尾位于文件末尾；追加写入中断时其后是不完整的新块
+    '''
+    if size < _HEADER.size + _FOOTER.size:
+        return None
+    _magic_offset = _FOOTER.size - len(_FOOTER_MAGIC)
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as _m:
+        _end = size
+        while True:
+            _pos = _m.rfind(_FOOTER_MAGIC, _HEADER.size + _magic_offset, _end)
+            if _pos < 0:
+                return None
+            _footer_end = _pos + len(_FOOTER_MAGIC)
+            _index_offset, _index_length, _ = _FOOTER.unpack_from(_m, _footer_end - _FOOTER.size)
+            if _index_offset >= _HEADER.size and _index_offset + _index_length + _FOOTER.size == _footer_end:
+                return _index_offset, _index_length, _footer_end
+            #不完整的数据中恰好出现了标志，继续向前查找
+            _end = _pos + len(_FOOTER_MAGIC) - 1
+
+def _ReadIndex(f, size):
+    '读取最后一个有效的文件尾及其索引，返回(索引偏移, 索引, 文件尾结束位置)，没有有效的文件尾时返回None'
+    _r = _FindFooter(f, size)
+    if _r is None:
+        return None
+    _index_offset, _index_length, _footer_end = _r
+    f.seek(_index_offset)
+    return _index_offset, _UnpackIndex(f.read(_index_length)), _footer_end
+
+def _IndexEnd(f, offset, size):
+    '若offset处是被取代的索引及文件尾（追加写入前留下的），返回文件尾的结束位置，否则返回None'
+    _pos = offset
+    while _pos + _FOOTER.size <= size:
+        f.seek(_pos)
+        _data = f.read(max(_FOOTER.size, _INDEX.size))
+        _index_offset, _index_length, _magic = _FOOTER.unpack_from(_data)
+        if _magic == _FOOTER_MAGIC and _index_offset == offset and _index_length == _pos - offset:
+            return _pos + _FOOTER.size
+        if len(_data) < _INDEX.size:
+            return None
+        _min_len, _max_len = _INDEX.unpack_from(_data)[4:]
+        _pos += _INDEX.size + _min_len + _max_len
+    return None
+
+class ChunkedWriter(object):
+    '''
+            容器的写端
+        文件不存在时创建，存在时追加。Append的记录累积到chunk_size字节（未压缩）后压缩为一个块，Close时写入索引
+    '''
+    def __init__(self, filename, chunk_size=1<<20, level=6):
+        super(ChunkedWriter, self).__init__()
+        self.Filename = filename
+        self.ChunkSize = chunk_size
+        self.Level = level
+        self.__pending = bytearray()
+        self.__pending_count = 0
+        self.__pending_min = None
+        self.__pending_max = None
+        if os.path.exists(filename):
+            self.__f = open(filename, 'r+b')
+            _size = self.__f.seek(0, os.SEEK_END)
+            self.__f.seek(0)
+            if _HEADER.unpack(self.__f.read(_HEADER.size)) != (_MAGIC, _VERSION):
+                self.__f.close()
+                raise ValueError('invalid container "%s"' % filename)
+            _r = _ReadIndex(self.__f, _size)
+            if _r is None or _r[2] != _size:
+                self.__f.close()
+                raise ValueError('container "%s" has no valid index, use ChunkedWriter.Recover' % filename)
+            self.__index = _r[1]
+            #新块写在原文件尾之后，Close写入新的文件尾之前原索引保持有效
+            self.__f.seek(_size)
+        else:
+            self.__f = open(filename, 'wb')
+            self.__f.write(_HEADER.pack(_MAGIC, _VERSION))
+            self.__index = []
+        self.__count = sum(x[2] for x in self.__index)
+
+    @property
+    def Count(self):
+        '已写入的记录数，包括尚未成块的'
+        return self.__count
+
+    def Append(self, key, data):
+        _key = _Key(key)
+        #索引中的键长度为uint16
+        if len(_key) > 0xFFFF:
+            raise ValueError('key longer than 65535 bytes')
+        self.__pending += _RECORD.pack(len(_key), len(data))
+        self.__pending += _key
+        self.__pending += data
+        self.__pending_count += 1
+        self.__count += 1
+        if self.__pending_min is None or _key < self.__pending_min:
+            self.__pending_min = _key
+        if self.__pending_max is None or _key > self.__pending_max:
+            self.__pending_max = _key
+        if len(self.__pending) >= self.ChunkSize:
+            self.Flush()
+
+    def Flush(self):
+        '将累积的记录压缩写入为一个块'
+        if self.__pending_count == 0:
+            return
+        _data = zlib.compress(self.__pending, self.Level)
+        _offset = self.__f.tell()
+        self.__f.write(_CHUNK.pack(_CHUNK_MAGIC, len(_data), self.__pending_count))
+        self.__f.write(_data)
+        self.__index.append((_offset, len(_data), self.__pending_count, self.__count - self.__pending_count, self.__pending_min, self.__pending_max))
+        self.__pending = bytearray()
+        self.__pending_count = 0
+        self.__pending_min = None
+        self.__pending_max = None
+
+    def Close(self):
+        '写入剩余记录、索引及文件尾'
+        if self.__f is None:
+            return
+        self.Flush()
+        _index = _PackIndex(self.__index)
+        _offset = self.__f.tell()
+        self.__f.write(_index)
+        self.__f.write(_FOOTER.pack(_offset, len(_index), _FOOTER_MAGIC))
+        self.__f.flush()
+        os.fsync(self.__f.fileno())
+        self.__f.close()
+        self.__f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    @staticmethod
+    def Recover(filename):
+        '''
+                按块头重建索引，用于写入中断后的文件。不完整或损坏的块及其后的数据被截去
+            返回保留的块数
+        '''
+        _index = []
+        _first = 0
+        with open(filename, 'r+b') as _f:
+            _size = _f.seek(0, os.SEEK_END)
+            _f.seek(0)
+            if _HEADER.unpack(_f.read(_HEADER.size)) != (_MAGIC, _VERSION):
+                raise ValueError('invalid container "%s"' % filename)
+            _offset = _HEADER.size
+            while _offset + _CHUNK.size <= _size:
+                _f.seek(_offset)
+                _magic, _length, _count = _CHUNK.unpack(_f.read(_CHUNK.size))
+                if _magic != _CHUNK_MAGIC:
+                    #追加写入前的索引及文件尾，跳过
+                    _end = _IndexEnd(_f, _offset, _size)
+                    if _end is None:
+                        break
+                    _offset = _end
+                    continue
+                if _offset + _CHUNK.size + _length > _size:
+                    break
+                try:
+                    _keys = [_k for _k, _ in _ParseRecords(zlib.decompress(_f.read(_length)))]
+                except (zlib.error, struct.error):
+                    break
+                if len(_keys) != _count:
+                    break
+                _index.append((_offset, _length, _count, _first, min(_keys), max(_keys)))
+                _first += _count
+                _offset += _CHUNK.size + _length
+            _data = _PackIndex(_index)
+            _f.truncate(_offset)
+            _f.seek(_offset)
+            _f.write(_data)
+            _f.write(_FOOTER.pack(_offset, len(_data), _FOOTER_MAGIC))
+            _f.flush()
+            os.fsync(_f.fileno())
+        return len(_index)
+
+class ChunkedReader(object):
+    '''
+            容器的读端
+        以mmap方式打开，只解析索引；最近解压的CACHE_CHUNKS个块被缓存，访问其中的记录不会重复解压
+        Scan使用的进程池在首次并行扫描时创建，之后的扫描复用，Close时关闭
+    '''
+    CACHE_CHUNKS = 4
+    #并行扫描时每个进程最多同时处理的块数，已解压但尚未被取走的块数因此受限
+    PENDING_PER_PROCESS = 2
+
+    def __init__(self, filename):
+        super(ChunkedReader, self).__init__()
+        self.Filename = filename
+        with open(filename, 'rb') as _f:
+            _size = _f.seek(0, os.SEEK_END)
+            _f.seek(0)
+            if _HEADER.unpack(_f.read(_HEADER.size)) != (_MAGIC, _VERSION):
+                raise ValueError('invalid container "%s"' % filename)
+            _r = _ReadIndex(_f, _size)
+            if _r is None:
+                raise ValueError('container "%s" has no valid index, use ChunkedWriter.Recover' % filename)
+            self.__index = _r[1]
+            self.__mmap = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__firsts = [x[3] for x in self.__index]
+        self.__cached = collections.OrderedDict()          #key=块序号, value=[(key, data), ...]
+        self.__executor = None
+        self.__processes = None
+
+    @property
+    def Count(self):
+        return sum(x[2] for x in self.__index)
+
+    @property
+    def ChunkCount(self):
+        return len(self.__index)
+
+    def ReadChunk(self, i):
+        '解压第i块，返回[(key, data), ...]'
+        _records = self.__cached.get(i)
+        if not _records is None:
+            self.__cached.move_to_end(i)
+            return _records
+        _offset, _length = self.__index[i][:2]
+        _start = _offset + _CHUNK.size
+        _records = _ParseRecords(zlib.decompress(self.__mmap[_start:_start+_length]))
+        self.__cached[i] = _records
+        if len(self.__cached) > self.CACHE_CHUNKS:
+            self.__cached.popitem(last=False)
+        return _records
+
+    def Record(self, n):
+        '按写入顺序的第n条记录，返回(key, data)'
+        if n < 0 or n >= self.Count:
+            raise IndexError('record %d out of range' % n)
+        _i = bisect.bisect_right(self.__firsts, n) - 1
+        return self.ReadChunk(_i)[n - self.__firsts[_i]]
+
+    def Get(self, key, **kwargs):
+        '按键读取数据。只解压键范围包含key的块，从后向前查找'
+        _key = _Key(key)
+        for _i in range(len(self.__index) - 1, -1, -1):
+            _min, _max = self.__index[_i][4:]
+            if _min <= _key <= _max:
+                for _k, _data in reversed(self.ReadChunk(_i)):
+                    if _k == _key:
+                        return _data
+        if 'default' in kwargs:
+            return kwargs['default']
+        raise KeyError('"%s" not found' % key)
+
+    def Has(self, key):
+        return not self.Get(key, default=None) is None
+
+    def __iter__(self):
+        for _i in range(len(self.__index)):
+            yield from self.ReadChunk(_i)
+
+    def __GetExecutor(self, processes):
+        if self.__executor is None or self.__processes != processes:
+            if not self.__executor is None:
+                self.__executor.shutdown()
+            self.__executor = ProcessPoolExecutor(processes)
+            self.__processes = processes
+        return self.__executor
+
+    def Scan(self, func=None, processes=None):
+        '''
+                按写入顺序遍历全部记录，各块在processes个进程中并行解压。
+            processes为None时使用CPU数个进程；processes不大于1（或为None且只有一个CPU）时在当前进程中顺序执行
+            func不为None时在工作进程中对每条记录调用func(key, data)，产生其返回值，func须可被pickle（模块级函数）。
+            func为None时每条记录都要从工作进程传回，只需要部分结果时应在func中完成计算
+            同时提交的块数不超过PENDING_PER_PROCESS*进程数，遍历的速度慢于解压时不会积压全部数据
+        '''
+        if len(self.__index) == 0:
+            return
+        _processes = (os.cpu_count() or 1) if processes is None else processes
+        if _processes <= 1:
+            for _offset, _length in (x[:2] for x in self.__index):
+                yield from _DecodeChunk(self.Filename, _offset, _length, func)
+            return
+        _executor = self.__GetExecutor(_processes)
+        _pending = collections.deque()
+        try:
+            for _offset, _length in (x[:2] for x in self.__index):
+                if len(_pending) >= self.PENDING_PER_PROCESS * _processes:
+                    yield from _pending.popleft().result()
+                _pending.append(_executor.submit(_DecodeChunk, self.Filename, _offset, _length, func))
+            while _pending:
+                yield from _pending.popleft().result()
+        finally:
+            #遍历被中止时取消尚未开始的块
+            for _future in _pending:
+                _future.cancel()
+
+    def Close(self):
+        if not self.__mmap is None:
+            self.__mmap.close()
+            self.__mmap = None
+        if not self.__executor is None:
+            self.__executor.shutdown()
+            self.__executor = None
+        self.__cached.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def __str__(self):
+        return '<%s Filename=%s Count=%d Chunks=%d>' % (self.__class__.__name__, self.Filename, self.Count, self.ChunkCount)
+
+##############################
+##############################
+
+def _RecordLength(key, data):
+    return len(data)
+
+def test_Chunked(filename='test_container.zck', count=200000):
+    import time
+    if os.path.exists(filename):
+        os.remove(filename)
+    with ChunkedWriter(filename, chunk_size=1<<18) as _writer:
+        for _i in range(count // 2):
+            _writer.Append('key%08d' % _i, b'value %d ' % _i * 8)
+    with ChunkedWriter(filename, chunk_size=1<<18) as _writer:
+        for _i in range(count // 2, count):
+            _writer.Append('key%08d' % _i, b'value %d ' % _i * 8)
+        _writer.Append('key%08d' % 0, b'updated')
+    with ChunkedReader(filename) as _reader:
+        print(_reader)
+        assert _reader.Get('key%08d' % 12345) == b'value 12345 ' * 8
+        assert _reader.Get('key%08d' % 0) == b'updated'
+        assert _reader.Record(count - 1)[0] == b'key%08d' % (count - 1)
+        _t = time.time()
+        for _i in range(0, count, 997):
+            _reader.Get('key%08d' % _i)
+        print('random Get    %.3f ms' % ((time.time() - _t) / (count // 997 + 1) * 1000))
+        #第二次并行扫描复用进程池
+        for _processes in [0, 2, 2]:
+            _t = time.time()
+            _total = sum(_reader.Scan(_RecordLength, processes=_processes))
+            print('Scan(processes=%s) %d bytes %.3f s' % (_processes, _total, time.time() - _t))
+        #中止遍历
+        for _n, _record in enumerate(_reader.Scan(processes=2)):
+            if _n == 10:
+                break
+    #模拟追加写入中断：新块已写入但没有新的文件尾，读取得到上次完成写入时的内容
+    _writer = ChunkedWriter(filename, chunk_size=1<<10)
+    for _i in range(100):
+        _writer.Append('new%08d' % _i, b'value %d ' % _i * 8)
+    _writer.Flush()
+    del _writer
+    with ChunkedReader(filename) as _reader:
+        assert _reader.Count == count + 1 and not _reader.Has('new%08d' % 0)
+    try:
+        ChunkedWriter(filename)
+        assert False
+    except ValueError:
+        pass
+    print('recovered chunks', ChunkedWriter.Recover(filename))
+    with ChunkedReader(filename) as _reader:
+        assert _reader.Count == count + 101 and _reader.Get('new%08d' % 99) == b'value 99 ' * 8
+        assert _reader.Get('key%08d' % 0) == b'updated' and _reader.Record(count)[0] == b'key%08d' % 0
+    #去掉文件尾
+    with open(filename, 'r+b') as _f:
+        _f.truncate(_f.seek(0, os.SEEK_END) - 10)
+    print('recovered chunks', ChunkedWriter.Recover(filename))
+    with ChunkedReader(filename) as _reader:
+        assert _reader.Count == count + 101
+    os.remove(filename)
+
+if __name__ == '__main__':
+    test_Chunked()
@@ -25,45 +25,183 @@ Created on 2019年12月3日
         LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN 
         CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
+import os
+import sys
+import mmap
+import json
+import struct
+import pickle
+import contextlib
+import collections
+import asyncio
+import logging
+from threading import Thread, Condition
+
 import cacheout
 
+#CacheRegistry.Get中表示注册项不存在
+_MISSING = object()
+#RegistryFeed.Coalesce中clear变更的键
+_CLEAR = object()
+
+#快照文件格式：头部（标志、版本、编码方式、索引位置），各个值的编码数据，名称索引
+_SNAPSHOT_MAGIC = b'KVS!'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<4sBBQ')
+_CODEC_PICKLE = 0
+_CODEC_SERIALIZER = 1
+#变更日志中每条记录的头部：操作（S=设置，D=删除，C=清空），数据长度
+_LOG_RECORD = struct.Struct('<cI')
+
+def _SnapshotEncode(serializer, obj):
+    '快照及变更日志中值的编码。serializer为None时使用pickle'
+    if serializer is None:
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    _r = serializer.DumpedToString(serializer.Dump(obj))
+    return _r.encode('utf8') if isinstance(_r, str) else _r
+
+def _SnapshotDecode(serializer, data):
+    if serializer is None:
+        return pickle.loads(data)
+    return serializer.Load(serializer.DumpedFromString(bytes(data)))
+
+def _SnapshotWrite(filename, serializer, entries):
+    '''
+            写入快照文件，entries为(name, 编码后的值)序列，返回名称索引[(name, offset, length), ...]
+        先写入临时文件再替换，写入过程中崩溃不会破坏原有快照
+    '''
+    _codec = _CODEC_PICKLE if serializer is None else _CODEC_SERIALIZER
+    _index = []
+    _tmp = filename + '.tmp'
+    with open(_tmp, 'wb') as _f:
+        _f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, _codec, 0))
+        _offset = _SNAPSHOT_HEADER.size
+        for _name, _data in entries:
+            _f.write(_data)
+            _index.append((_name, _offset, len(_data)))
+            _offset += len(_data)
+        if serializer is None:
+            _f.write(pickle.dumps(_index, pickle.HIGHEST_PROTOCOL))
+        else:
+            #字符串名称直接写入，其他类型的名称通过serializer导出
+            _f.write(json.dumps([[_n if isinstance(_n, str) else {'name':serializer.Dump(_n)}, _o, _l] for _n, _o, _l in _index], ensure_ascii=False).encode('utf8'))
+        _f.seek(0)
+        _f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, _codec, _offset))
+        _f.flush()
+        os.fsync(_f.fileno())
+    os.replace(_tmp, filename)
+    return _index
+
+def _SnapshotOpen(filename, serializer):
+    '以mmap方式打开快照文件，仅解析名称索引。返回(mmap, index)'
+    with open(filename, 'rb') as _f:
+        _mmap = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+    _magic, _version, _codec, _offset = _SNAPSHOT_HEADER.unpack_from(_mmap, 0)
+    if _magic != _SNAPSHOT_MAGIC or _version != _SNAPSHOT_VERSION:
+        _mmap.close()
+        raise ValueError('invalid snapshot "%s"' % filename)
+    if _codec != (_CODEC_PICKLE if serializer is None else _CODEC_SERIALIZER):
+        _mmap.close()
+        raise ValueError('snapshot "%s" was written with another codec' % filename)
+    if serializer is None:
+        _index = pickle.loads(_mmap[_offset:])
+    else:
+        _index = [(_n if isinstance(_n, str) else serializer.Load(_n['name']), _o, _l) for _n, _o, _l in json.loads(_mmap[_offset:])]
+    return _mmap, _index
+
 class  Registry(object):
     '''
             键值实现的注册库
         直接使用cacheout来实现
     '''
+    #变更日志保留的最大条数。Watch的订阅者落后超过此数量时，以全量快照重新同步
+    CHANGE_LOG_SIZE = 10000
+
     def __init__(self, func_before_register=None, func_after_register=None, func_before_unregister=None, func_after_unregister=None):
         super(Registry, self).__init__()
-        #创建cacheout.Cache对象存储注册项。maxsize=0禁止淘汰算法，ttl=0禁止超时算法
-        self.__items = cacheout.Cache(maxsize=0,ttl=0)
+        self.__items = self._CreateCache()
+        #版本号，每次变更递增
+        self.__revision = 0
+        self.__feed = None
         self.FuncBeforeRegister = func_before_register
         self.FuncAfterRegister = func_after_register
         self.FuncBeforeUnregister = func_before_unregister
         self.FuncAfterUnregister = func_after_unregister
+        #批量注册/删除时的回调，参数中携带全部注册项。未设置时对每一项调用上面的单项回调
+        self.FuncBeforeRegisterMany = None
+        self.FuncAfterRegisterMany = None
+        self.FuncBeforeUnregisterMany = None
+        self.FuncAfterUnregisterMany = None
+        #批量操作期间持有的锁，与cacheout.Cache内部使用的是同一把锁（cacheout的私有属性_lock，按cacheout 0.17确认，升级时需复核）
+        self._Lock = self.__items._lock
         self.items = self.__items.items
         self.keys = self.__items.keys
         self.values = self.__items.values
 
+    def _CreateCache(self):
+        '创建cacheout.Cache对象存储注册项。maxsize=0禁止淘汰算法，ttl=0禁止超时算法'
+        return cacheout.Cache(maxsize=0,ttl=0)
+
     @property
     def AsDict(self):
         return dict(self.__items.copy())
     @AsDict.setter
     def AsDict(self, value):
-        self.Clear()
-        self.__items.add_many(value)
+        with self._Lock:
+            self.Clear()
+            self.__items.add_many(value)
+            self._Changed('register', list(value.items()))
     
     @property
     def Count(self):
         return self.__items.size()
+
+    @property
+    def Revision(self):
+        '版本号。每个注册项的增删（或一次清空）使其加1'
+        return self.__revision
+
+    def _Changed(self, op, items):
+        '记录变更并递增版本号。op为register、unregister或clear，items为[(name, value), ...]'
+        with self._Lock:
+            if op == 'clear':
+                items = [(None, None)]
+            if self.__feed is None:
+                self.__revision += len(items)
+            else:
+                _changes = []
+                for _name, _value in items:
+                    self.__revision += 1
+                    _changes.append((self.__revision, op, _name, _value))
+                self.__feed.Append(_changes)
+
+    def Watch(self, callback=None, since_revision=None):
+        '''
+                订阅变更，返回RegistryWatcher
+            变更由后台线程合并后批量通知，不占用注册/删除的调用线程。批量数据为dict(revision, changes, snapshot)，
+            changes为[(revision, op, name, value), ...]，同一名称只保留最后一次变更；订阅者落后于变更日志时changes为空，
+            snapshot为当时的全部注册项，否则snapshot为None
+            指定callback时在后台线程中调用callback(watcher, batch)；否则须在协程中调用，通过async for逐批获取
+            since_revision为None时只接收此后的变更
+        '''
+        with self._Lock:
+            if self.__feed is None:
+                self.__feed = RegistryFeed(self, self.CHANGE_LOG_SIZE)
+            return self.__feed.Watch(callback, self.__revision if since_revision is None else since_revision)
         
     def Clear(self):
-        self.__items.clear()
+        with self._Lock:
+            self.__items.clear()
+            self._Changed('clear', [])
         
     def Register(self, name, value):
         '添加一个注册项。如果已存在则抛出错误'
         if callable(self.FuncBeforeRegister):
             self.FuncBeforeRegister(self, name, value) 
-        self.__items.add(name, value)
+        with self._Lock:
+            if not self.__items.has(name):
+                self.__items.add(name, value)
+                self._Changed('register', [(name, value)])
         if callable(self.FuncAfterRegister):
             self.FuncAfterRegister(self, name, value) 
     
@@ -71,10 +209,75 @@ class  Registry(object):
         '删除一个注册项'
         if callable(self.FuncBeforeUnregister):
             self.FuncBeforeUnregister(self, name) 
-        self.__items.delete(name)
+        with self._Lock:
+            if self.__items.delete(name):
+                self._Changed('unregister', [(name, None)])
         if callable(self.FuncAfterUnregister):
             self.FuncAfterUnregister(self, name) 
     
+    def RegisterMany(self, items):
+        '''
+                批量添加注册项。items为dict或(name, value)序列
+            所有名称在添加前统一检查，存在重复时抛出错误且不添加任何一项；注册前的回调抛出错误时同样不添加任何一项
+            与Register不同，注册前的回调（FuncBeforeRegisterMany或逐项的FuncBeforeRegister）在锁内执行，
+            以保证检查与添加之间没有其他线程修改注册库，回调中不能等待其他需要该锁的线程
+        '''
+        _items = self._ItemsToRegister(items)
+        with self._Lock:
+            for _name in _items:
+                if self.__items.has(_name):
+                    raise KeyError('"%s" exists' % _name)
+            if callable(self.FuncBeforeRegisterMany):
+                self.FuncBeforeRegisterMany(self, _items)
+            elif callable(self.FuncBeforeRegister):
+                for _name, _value in _items.items():
+                    self.FuncBeforeRegister(self, _name, _value)
+            self.__items.set_many(_items)
+            self._Changed('register', list(_items.items()))
+        if callable(self.FuncAfterRegisterMany):
+            self.FuncAfterRegisterMany(self, _items)
+        elif callable(self.FuncAfterRegister):
+            for _name, _value in _items.items():
+                self.FuncAfterRegister(self, _name, _value)
+
+    def UnregisterMany(self, names):
+        '''
+                批量删除注册项，返回被删除的值列表
+            所有名称在删除前统一检查，存在未注册的名称时抛出错误且不删除任何一项；删除前的回调抛出错误时同样不删除任何一项
+            与Unregister不同，删除前的回调在锁内执行，限制同RegisterMany
+        '''
+        _names = list(dict.fromkeys(names))
+        with self._Lock:
+            for _name in _names:
+                if not self.__items.has(_name):
+                    raise KeyError('"%s" not found' % _name)
+            if callable(self.FuncBeforeUnregisterMany):
+                self.FuncBeforeUnregisterMany(self, _names)
+            elif callable(self.FuncBeforeUnregister):
+                for _name in _names:
+                    self.FuncBeforeUnregister(self, _name)
+            _values = [self.__items.get(_name) for _name in _names]
+            self.__items.delete_many(_names)
+            self._Changed('unregister', [(_name, None) for _name in _names])
+        if callable(self.FuncAfterUnregisterMany):
+            self.FuncAfterUnregisterMany(self, _names)
+        elif callable(self.FuncAfterUnregister):
+            for _name in _names:
+                self.FuncAfterUnregister(self, _name)
+        return _values
+
+    @staticmethod
+    def _ItemsToRegister(items):
+        '将批量注册的参数整理为dict。参数自身包含重复名称时抛出错误'
+        if hasattr(items, 'items'):
+            return dict(items.items())
+        _r = {}
+        for _name, _value in items:
+            if _name in _r:
+                raise KeyError('"%s" exists' % _name)
+            _r[_name] = _value
+        return _r
+    
     def Get(self, name, **kwargs):
         '获取注册项的值'
         if 'default' in kwargs:
@@ -86,7 +289,36 @@ class  Registry(object):
                 raise KeyError('"%s" not found' % name)
     
     def _Set(self, name, value):
+        with self._Lock:
+            self.__items.set(name, value)
+            self._Changed('register', [(name, value)])
+
+    def _Delete(self, name):
+        with self._Lock:
+            if self.__items.delete(name):
+                self._Changed('unregister', [(name, None)])
+
+    def _RawSet(self, name, value):
+        '直接写入缓存，不递增版本号、不通知订阅者。用于载入已有数据（如解码延迟加载的值、重放日志），而非真正的变更'
         self.__items.set(name, value)
+
+    def _RawDelete(self, name):
+        self.__items.delete(name)
+
+    def _RawClear(self):
+        self.__items.clear()
+
+    def SaveSnapshot(self, filename, serializer=None):
+        '将所有注册项保存为快照文件。serializer为None时使用pickle编码，否则使用serializer（如SerializerForJSON）'
+        _SnapshotWrite(filename, serializer, ((_k, _SnapshotEncode(serializer, _v)) for _k, _v in self.items()))
+
+    def LoadSnapshot(self, filename, serializer=None):
+        '从快照文件中载入全部注册项。serializer需与保存时一致'
+        _mmap, _index = _SnapshotOpen(filename, serializer)
+        try:
+            self.RegisterMany([(_n, _SnapshotDecode(serializer, _mmap[_o:_o+_l])) for _n, _o, _l in _index])
+        finally:
+            _mmap.close()
     
     def Has(self, name):
         '检查注册项是否存在'
@@ -114,6 +346,481 @@ class  Registry(object):
 #         return '<%s Count=%d>' % (self.__class__.__name__, len(self.__items))
     
 #-----------------------------
+
+class PersistentRegistry(Registry):
+    '''
+            可持久化的注册库
+        启动时以mmap方式打开快照文件，只解析名称索引，值在首次访问时才被解码
+        两次快照之间的变更追加写入变更日志（快照文件名+'.log'），启动时在快照之上重放
+        Compact将当前内容写为新的快照并清空变更日志
+    '''
+    def __init__(self, filename, serializer=None, sync=False, **kwargs):
+        super(PersistentRegistry, self).__init__(**kwargs)
+        self.Filename = filename
+        self.Serializer = serializer
+        #为True时每次写入变更日志后执行fsync
+        self.Sync = sync
+        self.__lazy = {}            #key=name, value=(offset, length)，尚未解码的注册项
+        self.__mmap = None
+        self.__log = None
+        self.__cache_items = self.items
+        #以下函数需要访问全部的值，调用前先解码所有注册项
+        self.items = self.__Materialized(self.items)
+        self.keys = self.__Materialized(self.keys)
+        self.values = self.__Materialized(self.values)
+        self.Open()
+
+    @property
+    def LogFilename(self):
+        return self.Filename + '.log'
+
+    def Open(self):
+        '打开快照文件并重放变更日志'
+        with self._Lock:
+            if os.path.exists(self.Filename):
+                self.__mmap, _index = _SnapshotOpen(self.Filename, self.Serializer)
+                self.__lazy = {_n: (_o, _l) for _n, _o, _l in _index}
+            if os.path.exists(self.LogFilename):
+                self.__Replay()
+            self.__log = open(self.LogFilename, 'ab')
+
+    def Close(self):
+        with self._Lock:
+            if not self.__log is None:
+                self.__log.close()
+                self.__log = None
+            if not self.__mmap is None:
+                self.LoadAll()
+                self.__mmap.close()
+                self.__mmap = None
+
+    def Compact(self):
+        '将当前内容写为新的快照并清空变更日志。尚未解码的注册项直接复制原始数据'
+        with self._Lock:
+            _entries = [(_n, self.__mmap[_o:_o+_l]) for _n, (_o, _l) in self.__lazy.items()]
+            _entries.extend((_k, _SnapshotEncode(self.Serializer, _v)) for _k, _v in self.__cache_items())
+            #Windows下仍被映射的文件不能被替换，未解码的数据已复制，先关闭映射
+            if not self.__mmap is None:
+                self.__mmap.close()
+                self.__mmap = None
+            try:
+                _index = _SnapshotWrite(self.Filename, self.Serializer, _entries)
+            finally:
+                #写入失败时原快照未被替换，重新映射后未解码项的位置仍然有效
+                if os.path.exists(self.Filename):
+                    self.__mmap, _ = _SnapshotOpen(self.Filename, self.Serializer)
+            self.__lazy = {_n: (_o, _l) for _n, _o, _l in _index[:len(self.__lazy)]}
+            self.__log.close()
+            self.__log = open(self.LogFilename, 'wb')
+
+    def LoadAll(self):
+        '解码所有尚未解码的注册项'
+        with self._Lock:
+            for _name in list(self.__lazy.keys()):
+                self.__Materialize(_name)
+
+    def __Materialize(self, name):
+        if name in self.__lazy:
+            with self._Lock:
+                _pos = self.__lazy.pop(name, None)
+                if not _pos is None:
+                    _offset, _length = _pos
+                    self._RawSet(name, _SnapshotDecode(self.Serializer, self.__mmap[_offset:_offset+_length]))
+
+    def __Materialized(self, func):
+        def wrapper(*args, **kwargs):
+            self.LoadAll()
+            return func(*args, **kwargs)
+        return wrapper
+
+    def __Replay(self):
+        '在快照之上重放变更日志。日志尾部不完整的记录（写入时崩溃）被截断'
+        with open(self.LogFilename, 'rb') as _f:
+            _data = _f.read()
+        _pos = 0
+        while _pos + _LOG_RECORD.size <= len(_data):
+            _op, _length = _LOG_RECORD.unpack_from(_data, _pos)
+            if _pos + _LOG_RECORD.size + _length > len(_data):
+                break
+            _payload = _data[_pos+_LOG_RECORD.size:_pos+_LOG_RECORD.size+_length]
+            if _op == b'S':
+                _name, _value = _SnapshotDecode(self.Serializer, _payload)
+                self.__lazy.pop(_name, None)
+                self._RawSet(_name, _value)
+            elif _op == b'D':
+                _name = _SnapshotDecode(self.Serializer, _payload)
+                if self.__lazy.pop(_name, None) is None:
+                    self._RawDelete(_name)
+            elif _op == b'C':
+                self.__lazy.clear()
+                self._RawClear()
+            _pos += _LOG_RECORD.size + _length
+        if _pos < len(_data):
+            with open(self.LogFilename, 'r+b') as _f:
+                _f.truncate(_pos)
+
+    def __WriteLog(self, records):
+        '追加写入变更日志。records为[(op, 数据), ...]'
+        _buf = []
+        for _op, _obj in records:
+            _payload = b'' if _obj is None else _SnapshotEncode(self.Serializer, _obj)
+            _buf.append(_LOG_RECORD.pack(_op, len(_payload)))
+            _buf.append(_payload)
+        with self._Lock:
+            self.__log.write(b''.join(_buf))
+            self.__log.flush()
+            if self.Sync:
+                os.fsync(self.__log.fileno())
+
+    @property
+    def AsDict(self):
+        self.LoadAll()
+        return Registry.AsDict.fget(self)
+    @AsDict.setter
+    def AsDict(self, value):
+        self.Clear()
+        self.RegisterMany(value)
+
+    @property
+    def Count(self):
+        with self._Lock:
+            return Registry.Count.fget(self) + len(self.__lazy)
+
+    def Clear(self):
+        with self._Lock:
+            self.__lazy.clear()
+            super(PersistentRegistry, self).Clear()
+            self.__WriteLog([(b'C', None)])
+
+    def Register(self, name, value):
+        with self._Lock:
+            self.__Materialize(name)
+            _existed = super(PersistentRegistry, self).Has(name)
+            super(PersistentRegistry, self).Register(name, value)
+            if not _existed:
+                self.__WriteLog([(b'S', (name, value))])
+
+    def Unregister(self, name):
+        with self._Lock:
+            self.__Materialize(name)
+            _existed = super(PersistentRegistry, self).Has(name)
+            super(PersistentRegistry, self).Unregister(name)
+            if _existed:
+                self.__WriteLog([(b'D', name)])
+
+    def RegisterMany(self, items):
+        _items = self._ItemsToRegister(items)
+        with self._Lock:
+            for _name in _items:
+                self.__Materialize(_name)
+            super(PersistentRegistry, self).RegisterMany(_items)
+            self.__WriteLog([(b'S', (_n, _v)) for _n, _v in _items.items()])
+
+    def UnregisterMany(self, names):
+        _names = list(dict.fromkeys(names))
+        with self._Lock:
+            for _name in _names:
+                self.__Materialize(_name)
+            _r = super(PersistentRegistry, self).UnregisterMany(_names)
+            self.__WriteLog([(b'D', _n) for _n in _names])
+        return _r
+
+    def _Set(self, name, value):
+        with self._Lock:
+            self.__lazy.pop(name, None)
+            super(PersistentRegistry, self)._Set(name, value)
+            self.__WriteLog([(b'S', (name, value))])
+
+    def _Delete(self, name):
+        with self._Lock:
+            if self.__lazy.pop(name, None) is None:
+                super(PersistentRegistry, self)._Delete(name)
+            self.__WriteLog([(b'D', name)])
+
+    def Get(self, name, **kwargs):
+        self.__Materialize(name)
+        return super(PersistentRegistry, self).Get(name, **kwargs)
+
+    def Has(self, name):
+        return name in self.__lazy or super(PersistentRegistry, self).Has(name)
+
+    def Names(self):
+        with self._Lock:
+            return super(PersistentRegistry, self).Names() + list(self.__lazy.keys())
+
+    def Find(self, wildcard):
+        self.LoadAll()
+        return super(PersistentRegistry, self).Find(wildcard)
+
+class CacheRegistry(Registry):
+    '''
+            缓存模式的注册库
+        maxsize限制条目数，max_bytes限制估算的总字节数，ttl为超时秒数，三者为0时不限制。policy为LRU、LFU或FIFO
+        size_func用于估算值的字节数。未指定时，若指定了serializer则以导出的JSON字符串长度估算，否则使用sys.getsizeof
+        被淘汰或超时的注册项依次触发FuncOnEvict(registry, name, value, cause)和FuncAfterUnregister(registry, name)，
+        回调在缓存的锁内执行
+    '''
+    POLICIES = {'LRU':cacheout.LRUCache, 'LFU':cacheout.LFUCache, 'FIFO':cacheout.Cache}
+    #这些原因导致的删除计为淘汰，其余为Unregister等主动删除
+    EVICTION_CAUSES = (cacheout.RemovalCause.FULL, cacheout.RemovalCause.EXPIRED, cacheout.RemovalCause.POPITEM)
+
+    def __init__(self, maxsize=0, max_bytes=0, ttl=0, policy='LRU', size_func=None, serializer=None, func_on_evict=None, **kwargs):
+        if not policy in self.POLICIES:
+            raise ValueError('unknown cache policy "%s"' % policy)
+        self.MaxSize = maxsize
+        self.MaxBytes = max_bytes
+        self.TTL = ttl
+        self.Policy = policy
+        if size_func is None:
+            if serializer is None:
+                size_func = sys.getsizeof
+            else:
+                size_func = lambda value: len(serializer.DumpedToString(serializer.Dump(value)))
+        self.SizeFunc = size_func
+        self.FuncOnEvict = func_on_evict
+        self.__sizes = {}           #key=name, value=估算的字节数
+        self.__bytes = 0
+        self.__evictions = 0
+        super(CacheRegistry, self).__init__(**kwargs)
+
+    def _CreateCache(self):
+        self.__cache = self.POLICIES[self.Policy](maxsize=self.MaxSize, ttl=self.TTL, enable_stats=True, on_set=self.__OnSet, on_delete=self.__OnDelete)
+        return self.__cache
+
+    def __OnSet(self, name, value, old_value):
+        _size = self.SizeFunc(value)
+        self.__bytes += _size - self.__sizes.get(name, 0)
+        self.__sizes[name] = _size
+
+    def __OnDelete(self, name, value, cause):
+        self.__bytes -= self.__sizes.pop(name, 0)
+        if cause in self.EVICTION_CAUSES:
+            self.__evictions += 1
+            self._Changed('unregister', [(name, None)])
+            if callable(self.FuncOnEvict):
+                self.FuncOnEvict(self, name, value, cause)
+            if callable(self.FuncAfterUnregister):
+                self.FuncAfterUnregister(self, name)
+
+    def __Shrink(self):
+        '估算字节数超出max_bytes时按淘汰策略删除注册项'
+        if self.MaxBytes <= 0:
+            return
+        with self._Lock:
+            while self.__bytes > self.MaxBytes and self.__cache.size() > 0:
+                self.__cache.popitem()
+
+    @property
+    def Bytes(self):
+        '当前注册项估算的总字节数'
+        return self.__bytes
+
+    @property
+    def Stats(self):
+        '命中、未命中、淘汰次数，当前条目数及估算的字节数'
+        with self._Lock:
+            _stats = self.__cache.stats.info()
+            return dict(hits=_stats.hit_count, misses=_stats.miss_count, evictions=self.__evictions, count=self.__cache.size(), bytes=self.__bytes)
+
+    def ResetStats(self):
+        with self._Lock:
+            self.__cache.stats.reset()
+            self.__evictions = 0
+
+    def Clear(self):
+        with self._Lock:
+            super(CacheRegistry, self).Clear()
+            self.__sizes.clear()
+            self.__bytes = 0
+
+    @contextlib.contextmanager
+    def __Uncounted(self):
+        '注册、检查等操作内部也会访问缓存，不计入命中/未命中统计'
+        with self._Lock:
+            self.__cache.stats.pause()
+            try:
+                yield
+            finally:
+                self.__cache.stats.resume()
+
+    def Register(self, name, value):
+        with self.__Uncounted():
+            super(CacheRegistry, self).Register(name, value)
+        self.__Shrink()
+
+    def RegisterMany(self, items):
+        with self.__Uncounted():
+            super(CacheRegistry, self).RegisterMany(items)
+        self.__Shrink()
+
+    def UnregisterMany(self, names):
+        with self.__Uncounted():
+            return super(CacheRegistry, self).UnregisterMany(names)
+
+    def _Set(self, name, value):
+        super(CacheRegistry, self)._Set(name, value)
+        self.__Shrink()
+
+    def Has(self, name):
+        with self.__Uncounted():
+            return super(CacheRegistry, self).Has(name)
+
+    def Get(self, name, **kwargs):
+        '获取注册项的值，同时计入命中/未命中统计'
+        _r = self.__cache.get(name, default=_MISSING)
+        if _r is _MISSING:
+            if 'default' in kwargs:
+                return kwargs['default']
+            raise KeyError('"%s" not found' % name)
+        return _r
+
+class RegistryFeed(object):
+    '''
+            注册库的变更日志及分发
+        保存最近maxlen条变更，由后台线程将各订阅者尚未收到的变更合并成批后通知。
+        异步订阅者在上一批被取走之前不会收到新的一批，期间的变更在下一批中合并；落后超出日志范围时以快照重新同步
+    '''
+    def __init__(self, registry, maxlen):
+        super(RegistryFeed, self).__init__()
+        self.Registry = registry
+        self.__log = collections.deque(maxlen=maxlen)
+        self.__revision = registry.Revision
+        self.__cond = Condition()
+        self.__watchers = []
+        self.__thread = None
+
+    @property
+    def Revision(self):
+        return self.__revision
+
+    def Append(self, changes):
+        '追加变更，在注册库的锁内调用'
+        with self.__cond:
+            self.__log.extend(changes)
+            self.__revision = changes[-1][0]
+            self.__cond.notify()
+
+    def Watch(self, callback, since_revision):
+        _watcher = RegistryWatcher(self, callback, since_revision)
+        with self.__cond:
+            self.__watchers.append(_watcher)
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__Run, name='RegistryFeed', daemon=True)
+                self.__thread.start()
+            self.__cond.notify()
+        return _watcher
+
+    def Remove(self, watcher):
+        with self.__cond:
+            if watcher in self.__watchers:
+                self.__watchers.remove(watcher)
+            self.__cond.notify()
+
+    def Wake(self):
+        with self.__cond:
+            self.__cond.notify()
+
+    def __Pending(self):
+        return [x for x in self.__watchers if x.Revision < self.__revision and not x.InFlight]
+
+    def __Run(self):
+        while True:
+            with self.__cond:
+                _pending = self.__Pending()
+                while self.__watchers and not _pending:
+                    self.__cond.wait()
+                    _pending = self.__Pending()
+                if not self.__watchers:
+                    self.__thread = None
+                    return
+            for _watcher in _pending:
+                self.__Deliver(_watcher)
+
+    def __Deliver(self, watcher):
+        with self.__cond:
+            _oldest = self.__log[0][0] if self.__log else self.__revision + 1
+            _changes = None if watcher.Revision + 1 < _oldest else [x for x in self.__log if x[0] > watcher.Revision]
+        if _changes is None:
+            #日志中已缺少订阅者需要的变更，以全量快照重新同步
+            with self.Registry._Lock:
+                _batch = dict(revision=self.Registry.Revision, changes=[], snapshot=self.Registry.AsDict)
+        else:
+            _batch = dict(revision=_changes[-1][0], changes=self.Coalesce(_changes), snapshot=None)
+        watcher._Deliver(_batch)
+
+    @staticmethod
+    def Coalesce(changes):
+        '合并变更，同一名称只保留最后一次，clear之前的变更被丢弃'
+        _r = {}
+        for _change in changes:
+            if _change[1] == 'clear':
+                _r = {_CLEAR: _change}
+            else:
+                _r.pop(_change[2], None)
+                _r[_change[2]] = _change
+        return list(_r.values())
+
+class RegistryWatcher(object):
+    '''
+            注册库变更的订阅者，由Registry.Watch创建
+        未指定callback时作为异步迭代器使用：async for batch in watcher
+    '''
+    def __init__(self, feed, callback, revision):
+        super(RegistryWatcher, self).__init__()
+        self.Feed = feed
+        self.Callback = callback
+        #已收到的最新版本号
+        self.Revision = revision
+        #因落后而重新同步的次数
+        self.Resyncs = 0
+        #异步订阅者已投递但尚未取走一批
+        self.InFlight = False
+        self.__closed = False
+        if callback is None:
+            self.__loop = asyncio.get_running_loop()
+            self.__queue = asyncio.Queue()
+
+    def _Deliver(self, batch):
+        if not batch['snapshot'] is None:
+            self.Resyncs += 1
+        self.Revision = batch['revision']
+        if not self.Callback is None:
+            try:
+                self.Callback(self, batch)
+            except Exception:
+                logging.getLogger(__name__).exception('registry watcher callback failed')
+        else:
+            self.InFlight = True
+            try:
+                self.__loop.call_soon_threadsafe(self.__queue.put_nowait, batch)
+            except RuntimeError:
+                #事件循环已关闭
+                self.Close()
+
+    def Close(self):
+        if not self.__closed:
+            self.__closed = True
+            self.Feed.Remove(self)
+            if self.Callback is None:
+                try:
+                    self.__loop.call_soon_threadsafe(self.__queue.put_nowait, None)
+                except RuntimeError:
+                    pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.__closed and self.__queue.empty():
+            raise StopAsyncIteration
+        _batch = await self.__queue.get()
+        if _batch is None:
+            raise StopAsyncIteration
+        self.InFlight = False
+        self.Feed.Wake()
+        return _batch
+
+#-----------------------------
     
 class Registeable(object):
     '''
@@ -155,20 +862,18 @@ class RegisteableRegistry(Registry):
         
     @property
     def AsDict(self):
-        return super(RegisteableRegistry, self).AsDict()
+        return super(RegisteableRegistry, self).AsDict
     @AsDict.setter
     def AsDict(self, value):
         self.Clear()
-        for _k, _v in value.items():
-            self.Register(_k, _v)
+        self.RegisterMany(value)
 
     def _OnItemDel(self, value):
         for _it in self.NameOfValue(value):
             self.__items.delete(_it)
         
     def Clear(self):
-        for _name in self.Names():
-            self.Unregister(_name)
+        self.UnregisterMany(self.Names())
         
     def IsExists(self, name):
         if isinstance(name, Registeable):
@@ -201,6 +906,52 @@ class RegisteableRegistry(Registry):
             if hasattr(_value, 'OnAfterUnregister'):
                 _value.OnAfterUnregister(self)
         return _value
+
+    def RegisterMany(self, items):
+        '''
+                批量添加注册项
+            重复检查在触发任何OnBeforeRegister之前完成，注册失败时恢复各项的_notify_on_del
+        '''
+        _items = self._ItemsToRegister(items)
+        for _name in _items:
+            if self.Has(_name):
+                raise KeyError('"%s" exists' % _name)
+        _values = list(_items.values())
+        for _value in _values:
+            if hasattr(_value, 'OnBeforeRegister'):
+                _value.OnBeforeRegister(self)
+        _hooked = [x for x in _values if hasattr(x, '_notify_on_del')]
+        for _value in _hooked:
+            _value._old_notify_on_del = _value._notify_on_del
+            _value._notify_on_del = self._OnItemDel
+        try:
+            super(RegisteableRegistry, self).RegisterMany(_items)
+        except:
+            for _value in _hooked:
+                _value._notify_on_del = _value._old_notify_on_del
+            raise
+        for _value in _values:
+            if hasattr(_value, 'OnAfterRegister'):
+                _value.OnAfterRegister(self)
+
+    def UnregisterMany(self, names):
+        '批量删除注册项，返回被删除的值列表'
+        _names = list(dict.fromkeys(names))
+        for _name in _names:
+            if not self.Has(_name):
+                raise KeyError('"%s" not found' % _name)
+        _values = [self.Get(_name) for _name in _names]
+        for _value in _values:
+            if hasattr(_value, 'OnBeforeUnregister'):
+                _value.OnBeforeUnregister(self)
+        _values = super(RegisteableRegistry, self).UnregisterMany(_names)
+        for _value in _values:
+            if hasattr(_value, '_notify_on_del'):
+                _value._notify_on_del = _value._old_notify_on_del
+        for _value in _values:
+            if hasattr(_value, 'OnAfterUnregister'):
+                _value.OnAfterUnregister(self)
+        return _values
             
 #-------------------------------
 
@@ -228,5 +979,206 @@ class RegisteableRegistry(Registry):
 ######################
 #####################
 
+def test_RegisterMany():
+    _calls = []
+    def _Before(registry, name, value=None):
+        #注册时拒绝bad，删除时拒绝stuck
+        if name == ('stuck' if value is None else 'bad'):
+            raise ValueError(name)
+        _calls.append(('before', name))
+    _registry = Registry(func_before_register=_Before, func_after_register=lambda r, n, v: _calls.append(('after', n)),
+                         func_before_unregister=_Before, func_after_unregister=lambda r, n: _calls.append(('after', n)))
+    _registry.RegisterMany({'a':1, 'b':2})
+    assert _registry.AsDict == {'a':1, 'b':2} and _registry.Revision == 2
+    assert _calls == [('before', 'a'), ('before', 'b'), ('after', 'a'), ('after', 'b')]
+    #重复的名称、参数内重复、回调抛出错误时均不添加任何一项
+    for _items in [{'c':3, 'a':0}, [('c', 3), ('c', 4)], [('c', 3), ('bad', 4)]]:
+        del _calls[:]
+        try:
+            _registry.RegisterMany(_items)
+            assert False
+        except (KeyError, ValueError):
+            pass
+        assert not _registry.Has('c') and _registry.Revision == 2
+        assert not [x for x in _calls if x[0] == 'after']
+    _registry.Register('stuck', 0)
+    for _names in [['a', 'x'], ['a', 'stuck']]:
+        try:
+            _registry.UnregisterMany(_names)
+            assert False
+        except (KeyError, ValueError):
+            pass
+        assert _registry.Has('a') and _registry.Count == 3
+    del _calls[:]
+    assert _registry.UnregisterMany(['b', 'a', 'b']) == [2, 1]
+    assert _calls == [('before', 'b'), ('before', 'a'), ('after', 'b'), ('after', 'a')]
+    assert _registry.Names() == ['stuck'] and _registry.Revision == 5
+
+    class _Item(Registeable):
+        def __init__(self, name):
+            super(_Item, self).__init__()
+            self.Name = name
+            self.Events = []
+        def OnBeforeRegister(self, registry):
+            self.Events.append('before_register')
+        def OnAfterRegister(self, registry):
+            self.Events.append('after_register')
+        def OnBeforeUnregister(self, registry):
+            self.Events.append('before_unregister')
+        def OnAfterUnregister(self, registry):
+            self.Events.append('after_unregister')
+    _registry = RegisteableRegistry()
+    _x, _y = _Item('x'), _Item('y')
+    _registry.RegisterMany([('x', _x), ('y', _y)])
+    assert _x.Events == ['before_register', 'after_register'] and _y._notify_on_del == _registry._OnItemDel
+    _z = _Item('z')
+    try:
+        _registry.RegisterMany({'z':_z, 'x':_x})
+        assert False
+    except KeyError:
+        pass
+    assert _z.Events == [] and not _registry.Has('z')
+    assert _registry.UnregisterMany(['x', 'y']) == [_x, _y]
+    assert _y.Events == ['before_register', 'after_register', 'before_unregister', 'after_unregister']
+    assert _y._notify_on_del == _y._old_notify_on_del and _registry.Count == 0
+
+def test_PersistentRegistry():
+    import shutil
+    import tempfile
+    from pcs_base.serializer import SerializerForJSON, DumpedZipper
+    _dir = tempfile.mkdtemp()
+    try:
+        for _serializer in [None, SerializerForJSON(filters=[DumpedZipper])]:
+            _filename = os.path.join(_dir, 'registry_%s' % type(_serializer).__name__)
+            _registry = PersistentRegistry(_filename, _serializer)
+            _registry.RegisterMany({'a':1, 'b':[1, 2, 'x'], 'c':{'k':'v'}})
+            _registry.Compact()
+            _registry.Register('d', 'after snapshot')
+            _registry.Unregister('a')
+            _registry.Close()
+            #快照之上重放日志
+            _registry = PersistentRegistry(_filename, _serializer)
+            assert _registry.Count == 3 and _registry.Revision == 0
+            assert _registry.Get('b') == [1, 2, 'x'] and _registry.Get('d') == 'after snapshot' and not _registry.Has('a')
+            _registry.Clear()
+            _registry.Register('e', 5)
+            #写入时崩溃留下的不完整记录在重放时被截去
+            _registry.Close()
+            _size = os.path.getsize(_registry.LogFilename)
+            with open(_registry.LogFilename, 'ab') as _f:
+                _f.write(_LOG_RECORD.pack(b'S', 100) + b'torn')
+            _registry = PersistentRegistry(_filename, _serializer)
+            assert os.path.getsize(_registry.LogFilename) == _size and _registry.AsDict == {'e':5}
+            _registry.Register('f', 6)
+            #未解码的项在Compact后仍可读取
+            _registry.Compact()
+            assert os.path.getsize(_registry.LogFilename) == 0
+            _registry.Close()
+            _registry = PersistentRegistry(_filename, _serializer)
+            assert sorted(_registry.Names()) == ['e', 'f'] and _registry.Get('f') == 6
+            _registry.Compact()
+            assert _registry.AsDict == {'e':5, 'f':6}
+            _registry.Close()
+    finally:
+        shutil.rmtree(_dir)
+
+def test_CacheRegistry():
+    import time
+    _events = []
+    _registry = CacheRegistry(maxsize=3, func_on_evict=lambda r, n, v, c: _events.append(('evict', n, c)),
+                              func_after_unregister=lambda r, n: _events.append(('after', n)))
+    _registry.RegisterMany({'a':1, 'b':2, 'c':3})
+    assert _registry.Get('a') == 1
+    #条目数达到上限时淘汰最久未使用的b，先FuncOnEvict后FuncAfterUnregister
+    _registry.Register('d', 4)
+    assert _events == [('evict', 'b', cacheout.RemovalCause.FULL), ('after', 'b')]
+    assert sorted(_registry.Names()) == ['a', 'c', 'd']
+    assert _registry.Get('b', default=None) is None
+    _stats = _registry.Stats
+    assert (_stats['hits'], _stats['misses'], _stats['evictions'], _stats['count']) == (1, 1, 1, 3)
+    _registry.ResetStats()
+    assert _registry.Stats['hits'] == 0 and _registry.Stats['evictions'] == 0
+    #主动删除不计为淘汰
+    del _events[:]
+    _registry.Unregister('a')
+    assert _events == [('after', 'a')] and _registry.Stats['evictions'] == 0
+
+    #字节数上限
+    _registry = CacheRegistry(max_bytes=100, size_func=len, func_on_evict=lambda r, n, v, c: _events.append(('evict', n, c)))
+    del _events[:]
+    _registry.Register('x', b'0' * 60)
+    _registry.Register('y', b'1' * 30)
+    assert _registry.Bytes == 90
+    _registry.Register('z', b'2' * 30)
+    assert _registry.Bytes == 60 and sorted(_registry.Names()) == ['y', 'z']
+    assert _events == [('evict', 'x', cacheout.RemovalCause.POPITEM)]
+    _registry.Unregister('y')
+    assert _registry.Bytes == 30 and _registry.Stats['bytes'] == 30
+
+    #超时
+    _registry = CacheRegistry(ttl=0.05, func_on_evict=lambda r, n, v, c: _events.append(('evict', n, c)))
+    del _events[:]
+    _registry.Register('t', 1)
+    assert _registry.Get('t') == 1
+    time.sleep(0.1)
+    assert not _registry.Has('t') and _registry.Count == 0
+    assert _events == [('evict', 't', cacheout.RemovalCause.EXPIRED)] and _registry.Stats['evictions'] == 1
+
+def test_RegistryWatch():
+    import time
+    from threading import Event
+    assert RegistryFeed.Coalesce([(1, 'register', 'a', 1), (2, 'register', 'b', 2), (3, 'unregister', 'a', None)]) == \
+        [(2, 'register', 'b', 2), (3, 'unregister', 'a', None)]
+    assert RegistryFeed.Coalesce([(1, 'register', 'a', 1), (2, 'clear', None, None), (3, 'register', 'b', 2)]) == \
+        [(2, 'clear', None, None), (3, 'register', 'b', 2)]
+
+    _registry = Registry()
+    _registry.CHANGE_LOG_SIZE = 5
+    _batches = []
+    _done = Event()
+    _expected = [3]
+    def _Callback(watcher, batch):
+        _batches.append(batch)
+        if watcher.Revision >= _expected[0]:
+            _done.set()
+    _watcher = _registry.Watch(_Callback)
+    _registry.RegisterMany({'a':1, 'b':2})
+    _registry.Unregister('a')
+    assert _done.wait(5)
+    _changes = RegistryFeed.Coalesce([x for _batch in _batches for x in _batch['changes']])
+    assert _changes == [(2, 'register', 'b', 2), (3, 'unregister', 'a', None)]
+    assert all(_batch['snapshot'] is None for _batch in _batches) and _watcher.Resyncs == 0
+    _watcher.Close()
+    #落后超出变更日志时以快照重新同步
+    for _i in range(10):
+        _registry.Register('n%d' % _i, _i)
+    _batches = []
+    _done.clear()
+    _expected[0] = _registry.Revision
+    _watcher = _registry.Watch(_Callback, since_revision=0)
+    assert _done.wait(5)
+    _watcher.Close()
+    assert _batches[0]['snapshot'] == _registry.AsDict and _batches[0]['changes'] == [] and _watcher.Resyncs == 1
+
+    async def _Main():
+        _watcher = _registry.Watch()
+        _registry.Register('x', 1)
+        while not _watcher.InFlight:
+            await asyncio.sleep(0.01)
+        #上一批未取走期间的变更合并为下一批
+        _registry._Set('y', 1)
+        _registry._Set('y', 2)
+        _registry._Set('y', 3)
+        _r = []
+        async for _batch in _watcher:
+            _r.append(_batch['changes'])
+            if _batch['revision'] == _registry.Revision:
+                _watcher.Close()
+        return _r
+    assert asyncio.run(_Main()) == [[(14, 'register', 'x', 1)], [(17, 'register', 'y', 3)]]
+
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    test_RegisterMany()
+    test_PersistentRegistry()
+    test_CacheRegistry()
+    test_RegistryWatch()
\ No newline at end of file
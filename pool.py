@@ -0,0 +1,401 @@
+#coding: utf-8
+'''
+Created on 2026年10月19日
+
+以URL为键的资源池（连接、组件等）
+
+URL经Common.URL2DICT解析后规范化（scheme、netloc小写，参数排序）作为键，相同键的请求共用一个ResourcePool。
+资源由factory(url_dict)创建，destroyer(resource)销毁；health_check(resource)返回False时资源在取出时被销毁并重新获取。
+每个键可单独配置最小/最大数量及空闲超时，超时的空闲资源在Acquire/Release时被清理，但保留min_size个。
+'''
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import contextlib
+import collections
+from threading import Lock, Condition
+
+from pcs_base.Common import URL2DICT
+
+@functools.lru_cache(maxsize=4096)
+def _ParseURL(url):
+    _r = URL2DICT(url)
+    _params = tuple(sorted((_k, tuple(_v) if isinstance(_v, list) else _v) for _k, _v in _r['params'].items()))
+    return _r, (_r['scheme'].lower(), _r['netloc'].lower(), _r['path'], _params)
+
+def PARSE_URL(url):
+    '带缓存的URL2DICT。返回新的dict，修改它不影响缓存'
+    _r = _ParseURL(url)[0]
+    return dict(_r, params=dict(_r['params']))
+
+def URL_KEY(url):
+    '规范化的URL键，可作为dict的键。只有参数顺序或scheme、netloc大小写不同的URL得到相同的键'
+    return _ParseURL(url)[1]
+
+def _Wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+class ResourcePool(object):
+    '''
+            单个键的资源池
+        Acquire在没有空闲资源且数量已达到max_size时等待，超过timeout抛出TimeoutError
+        AcquireAsync在协程中以asyncio.Future等待，不占用线程；只有factory、health_check及destroyer在执行器中调用
+    '''
+    def __init__(self, factory, url, min_size=0, max_size=10, idle_timeout=0, health_check=None, destroyer=None):
+        super(ResourcePool, self).__init__()
+        self.Factory = factory
+        self.URL = url
+        self.MinSize = min_size
+        self.MaxSize = max_size
+        #空闲超过此秒数的资源被销毁，0表示不超时
+        self.IdleTimeout = idle_timeout
+        self.HealthCheck = health_check
+        self.Destroyer = destroyer
+        self.__idle = []                #[(resource, 放回时间), ...]，末尾为最近放回的
+        self.__size = 0                 #已创建且未销毁的资源数
+        self.__cond = Condition()
+        self.__waiters = collections.deque()    #[(事件循环, asyncio.Future), ...]，等待中的协程
+        self.__closed = False
+        for _ in range(min_size):
+            self.__size += 1
+            self.__idle.append((self.__Create(), time.monotonic()))
+
+    @property
+    def Size(self):
+        return self.__size
+
+    @property
+    def IdleCount(self):
+        return len(self.__idle)
+
+    def __Notify(self):
+        '在锁内调用，有资源放回或名额空出时唤醒一个等待的线程及一个等待的协程'
+        self.__cond.notify()
+        while self.__waiters:
+            _loop, _waiter = self.__waiters.popleft()
+            try:
+                _loop.call_soon_threadsafe(_Wake, _waiter)
+                return
+            except RuntimeError:
+                #事件循环已关闭，唤醒下一个
+                pass
+
+    def __Create(self):
+        '调用factory创建资源。名额须已在决定创建的同一锁内预留（__size加1），创建失败时归还'
+        try:
+            return self.Factory(PARSE_URL(self.URL))
+        except:
+            with self.__cond:
+                self.__size -= 1
+                self.__Notify()
+            raise
+
+    def __Destroy(self, resource):
+        with self.__cond:
+            self.__size -= 1
+            self.__Notify()
+        if callable(self.Destroyer):
+            self.Destroyer(resource)
+
+    def __Expired(self):
+        '取出超时的空闲资源，在锁内调用'
+        if self.IdleTimeout <= 0:
+            return []
+        _deadline = time.monotonic() - self.IdleTimeout
+        _count = 0
+        #__idle按放回时间排序，超时的都在头部
+        while _count < len(self.__idle) - self.MinSize and self.__idle[_count][1] < _deadline:
+            _count += 1
+        _r = [x[0] for x in self.__idle[:_count]]
+        del self.__idle[:_count]
+        return _r
+
+    def __Take(self):
+        '''
+                在锁内调用，不等待地取出资源。返回(空闲资源, 是否创建, 超时的空闲资源)
+            需要创建时名额已预留；没有空闲资源且数量已达到max_size时返回(None, False, [])
+        '''
+        if self.__closed:
+            raise RuntimeError('pool "%s" closed' % self.URL)
+        _expired = self.__Expired()
+        if self.__idle:
+            return self.__idle.pop()[0], False, _expired
+        if self.__size - len(_expired) < self.MaxSize:
+            self.__size += 1
+            return None, True, _expired
+        return None, False, _expired
+
+    def __Finish(self, resource, create, expired):
+        '在锁外完成__Take：销毁超时的空闲资源，创建资源或执行健康检查。健康检查失败时销毁资源并返回None'
+        for _it in expired:
+            self.__Destroy(_it)
+        if create:
+            return self.__Create()
+        if not callable(self.HealthCheck) or self.HealthCheck(resource):
+            return resource
+        self.__Destroy(resource)
+        return None
+
+    def Acquire(self, timeout=None):
+        '取出一个资源'
+        _deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.__cond:
+                while True:
+                    _resource, _create, _expired = self.__Take()
+                    if _create or not _resource is None:
+                        break
+                    _remaining = None if _deadline is None else _deadline - time.monotonic()
+                    if not _remaining is None and _remaining <= 0:
+                        raise TimeoutError('acquire "%s" timeout' % self.URL)
+                    self.__cond.wait(_remaining)
+            _r = self.__Finish(_resource, _create, _expired)
+            if not _r is None:
+                return _r
+
+    async def AcquireAsync(self, timeout=None, executor=None):
+        '''
+                在协程中取出一个资源
+            等待期间不占用线程；需要创建资源、执行健康检查或销毁超时资源时在executor（None为事件循环的默认执行器）中执行。
+            协程被取消时，执行器中仍在进行的创建或检查完成后资源被放回池中
+        '''
+        _loop = asyncio.get_running_loop()
+        _deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            _waiter = None
+            with self.__cond:
+                _resource, _create, _expired = self.__Take()
+                if not _create and _resource is None:
+                    _waiter = _loop.create_future()
+                    self.__waiters.append((_loop, _waiter))
+            if not _waiter is None:
+                _remaining = None if _deadline is None else max(_deadline - time.monotonic(), 0)
+                try:
+                    await asyncio.wait_for(_waiter, _remaining)
+                except asyncio.TimeoutError:
+                    self.__Unwait(_loop, _waiter)
+                    raise TimeoutError('acquire "%s" timeout' % self.URL) from None
+                except BaseException:
+                    self.__Unwait(_loop, _waiter)
+                    raise
+                continue
+            if not _create and not _expired and not callable(self.HealthCheck):
+                return _resource
+            _future = _loop.run_in_executor(executor, self.__Finish, _resource, _create, _expired)
+            try:
+                _r = await asyncio.shield(_future)
+            except asyncio.CancelledError:
+                _future.add_done_callback(lambda f: self.Release(f.result()) if not f.cancelled() and f.exception() is None and not f.result() is None else None)
+                raise
+            if not _r is None:
+                return _r
+
+    def __Unwait(self, loop, waiter):
+        '放弃等待。等待者已被__Notify取出（唤醒已发出）时将唤醒转给下一个，避免丢失'
+        with self.__cond:
+            try:
+                self.__waiters.remove((loop, waiter))
+            except ValueError:
+                self.__Notify()
+
+    def Release(self, resource, broken=False):
+        '放回资源。broken为True时直接销毁'
+        if broken or self.__closed:
+            self.__Destroy(resource)
+            return
+        with self.__cond:
+            self.__idle.append((resource, time.monotonic()))
+            _expired = self.__Expired()
+            self.__Notify()
+        for _it in _expired:
+            self.__Destroy(_it)
+
+    def Prune(self):
+        '销毁超时的空闲资源'
+        with self.__cond:
+            _expired = self.__Expired()
+        for _it in _expired:
+            self.__Destroy(_it)
+
+    def Close(self):
+        '销毁所有空闲资源，使用中的资源在放回时销毁'
+        with self.__cond:
+            self.__closed = True
+            _idle = [x[0] for x in self.__idle]
+            self.__idle = []
+            self.__cond.notify_all()
+            while self.__waiters:
+                self.__Notify()
+        for _it in _idle:
+            self.__Destroy(_it)
+
+class URLPool(object):
+    '''
+            按URL分组的资源池
+        构造参数作为各键的默认配置，Configure可为单个URL指定不同的配置（须在该URL首次使用前调用）
+        AcquireAsync等待时不占用线程，AcquireAsync/ReleaseAsync只在executor中调用factory、health_check及destroyer；
+        executor为None时使用本池专用的线程池（ASYNC_WORKERS个线程），不占用事件循环的默认执行器
+    '''
+    #专用线程池的线程数
+    ASYNC_WORKERS = 32
+
+    def __init__(self, factory, min_size=0, max_size=10, idle_timeout=0, health_check=None, destroyer=None, executor=None):
+        super(URLPool, self).__init__()
+        self.Factory = factory
+        self.Executor = executor
+        self.__own_executor = None
+        self.Options = dict(min_size=min_size, max_size=max_size, idle_timeout=idle_timeout, health_check=health_check, destroyer=destroyer)
+        self.__options = {}             #key=URL_KEY, value=单独的配置
+        self.__pools = {}               #key=URL_KEY, value=ResourcePool
+        self.__owners = {}              #key=id(resource), value=ResourcePool
+        self.__lock = Lock()
+
+    def Configure(self, url, **options):
+        with self.__lock:
+            self.__options[URL_KEY(url)] = options
+
+    def Pool(self, url):
+        '获取URL对应的ResourcePool，不存在时创建'
+        _key = URL_KEY(url)
+        _r = self.__pools.get(_key)
+        if _r is None:
+            with self.__lock:
+                _r = self.__pools.get(_key)
+                if _r is None:
+                    _r = self.__pools[_key] = ResourcePool(self.Factory, url, **dict(self.Options, **self.__options.get(_key, {})))
+        return _r
+
+    def __GetExecutor(self):
+        if not self.Executor is None:
+            return self.Executor
+        if self.__own_executor is None:
+            with self.__lock:
+                if self.__own_executor is None:
+                    self.__own_executor = ThreadPoolExecutor(self.ASYNC_WORKERS, thread_name_prefix='URLPool')
+        return self.__own_executor
+
+    def __Acquired(self, pool, resource):
+        with self.__lock:
+            self.__owners[id(resource)] = pool
+        return resource
+
+    def Acquire(self, url, timeout=None):
+        _pool = self.Pool(url)
+        return self.__Acquired(_pool, _pool.Acquire(timeout))
+
+    async def AcquireAsync(self, url, timeout=None):
+        '在协程中取出资源，参见ResourcePool.AcquireAsync'
+        _pool = self.Pool(url)
+        return self.__Acquired(_pool, await _pool.AcquireAsync(timeout, self.__GetExecutor()))
+
+    def Release(self, resource, broken=False):
+        with self.__lock:
+            _pool = self.__owners.pop(id(resource), None)
+        if _pool is None:
+            raise ValueError('resource not acquired from this pool')
+        _pool.Release(resource, broken)
+
+    async def ReleaseAsync(self, resource, broken=False):
+        '在协程中放回资源。销毁资源（destroyer）可能阻塞，在执行器中执行；等待中的AcquireAsync不占用执行器的线程，不会阻塞放回'
+        await asyncio.wrap_future(self.__GetExecutor().submit(self.Release, resource, broken))
+
+    @contextlib.contextmanager
+    def Connection(self, url, timeout=None):
+        '取出资源，with块结束时放回；块内抛出错误时资源被视为已损坏而销毁'
+        _resource = self.Acquire(url, timeout)
+        try:
+            yield _resource
+        except:
+            self.Release(_resource, broken=True)
+            raise
+        self.Release(_resource)
+
+    def Prune(self):
+        with self.__lock:
+            _pools = list(self.__pools.values())
+        for _pool in _pools:
+            _pool.Prune()
+
+    def Close(self):
+        with self.__lock:
+            _pools = list(self.__pools.values())
+            self.__pools.clear()
+            _executor = self.__own_executor
+            self.__own_executor = None
+        for _pool in _pools:
+            _pool.Close()
+        if not _executor is None:
+            _executor.shutdown(wait=False)
+
+##############################
+##############################
+
+def test_URLPool():
+    class _Connection(object):
+        Created = 0
+        def __init__(self, url_dict):
+            _Connection.Created += 1
+            self.URL = url_dict
+            self.Alive = True
+        def __repr__(self):
+            return '<_Connection %s%s>' % (self.URL['netloc'], self.URL['path'])
+
+    _pool = URLPool(_Connection, max_size=2, idle_timeout=0.1, health_check=lambda c: c.Alive, destroyer=lambda c: print('destroy', c))
+    _pool.Configure('amqp://host/logs', min_size=1)
+    assert URL_KEY('amqp://HOST/q?b=2&a=1') == URL_KEY('amqp://host/q?a=1&b=2')
+    with _pool.Connection('amqp://host/q?a=1&b=2') as _c1:
+        with _pool.Connection('AMQP://HOST/q?b=2&a=1') as _c2:
+            assert _c1 is not _c2
+            try:
+                _pool.Acquire('amqp://host/q?a=1&b=2', timeout=0.05)
+                assert False
+            except TimeoutError:
+                pass
+    with _pool.Connection('amqp://host/q?a=1&b=2') as _c3:
+        assert _c3 is _c1
+        _c3.Alive = False
+    with _pool.Connection('amqp://host/q?a=1&b=2') as _c4:
+        assert _c4 is _c2
+    time.sleep(0.2)
+    _pool.Prune()
+    assert _pool.Pool('amqp://host/logs').IdleCount == 1
+    async def _main():
+        _c = await _pool.AcquireAsync('amqp://host/q?a=1&b=2')
+        await _pool.ReleaseAsync(_c)
+        return _c
+    print('async', asyncio.run(_main()))
+    print('created', _Connection.Created)
+    _pool.Close()
+    #等待中的协程多于执行器线程数时，放回不会被阻塞，被取消的等待者不丢失唤醒
+    _pool = URLPool(_Connection, max_size=1)
+    _pool.ASYNC_WORKERS = 2
+    async def _contend():
+        _url = 'amqp://host/contend'
+        _c = await _pool.AcquireAsync(_url)
+        _order = []
+        async def _wait(index):
+            _r = await _pool.AcquireAsync(_url, timeout=1)
+            _order.append(index)
+            await _pool.ReleaseAsync(_r)
+        _tasks = [asyncio.ensure_future(_wait(x)) for x in range(4)]
+        _cancelled = asyncio.ensure_future(_pool.AcquireAsync(_url))
+        await asyncio.sleep(0.05)
+        _pool.Release(_c)
+        _cancelled.cancel()
+        await asyncio.gather(*_tasks)
+        _c = await _pool.AcquireAsync(_url, timeout=0.05)
+        try:
+            await _pool.AcquireAsync(_url, timeout=0.05)
+            assert False
+        except TimeoutError:
+            pass
+        await _pool.ReleaseAsync(_c)
+        return _order
+    _start = time.time()
+    assert asyncio.run(_contend()) == [0, 1, 2, 3] and time.time() - _start < 0.5
+    _pool.Close()
+
+if __name__ == '__main__':
+    test_URLPool()
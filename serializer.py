@@ -16,6 +16,7 @@ Created on 2019年11月24日
 NoType过滤器支持屏蔽对象类型信息（反序列化时无法反射原始类型，需自行解决）
 TypeZipper过滤器支持基本类型的数值使用单一字符串表示
 DumpedZipper过滤器支持封装压缩头，被压缩部分是完整JSON字符串，头部标志为'ZIP!'，不携带压缩方式
+已安装numpy时支持ndarray，dtype、shape与原始数据整体编码为base64；pack_numbers=True时纯数值列表以同样方式打包
 TODO:    可选封装加密头，被加密部分是完整JSON字符串，头部标志为C!，不携带秘钥
 
 MemberZipper         将成员的Dump结果的dict类型数据转换为"类型::值"字符串，未被注册到MemberZipper的类型不会被压缩。默认仅基本类型可被压缩
@@ -38,6 +39,8 @@ import decimal
 from threading import RLock
 import zlib
 import base64
+import array
+import sys
 
 from pcs_base.key_value import Registry
 
@@ -93,9 +96,11 @@ class SerializerForJSON(object):
     FuncBeforeUnregisterType = None
     FuncAfterUnregisterType = None
     
-    def __init__(self, filters=None):
+    def __init__(self, filters=None, pack_numbers=False):
         super(SerializerForJSON, self).__init__()
         self._Filters = filters if isinstance(filters, list) else []
+        #为True时全部为int或全部为float的列表整体打包编码
+        self.PackNumbers = pack_numbers
         self.__stack = []
         self.__stack_lock = RLock()
         
@@ -313,8 +318,29 @@ SerializerForJSON.RegisterType((datetime.datetime.min).__class__,
             {'creator':lambda ser: datetime.datetime.min, 'loader':lambda ser, data, define: datetime.datetime.strptime(data, STRING_DATETIME_FMT), 'dumper':lambda ser, obj, define:obj.strftime(STRING_DATETIME_FMT)})
 SerializerForJSON.RegisterType(decimal.Decimal(0).__class__,
             {'creator':lambda ser: decimal.Decimal(0), 'loader':lambda ser, data, define: decimal.Decimal(data), 'dumper':lambda ser, obj, define:str(obj)})
+#数值列表打包：全部为int或全部为float的列表整体编码为一个base64值，不逐元素Dump。需构造SerializerForJSON时指定pack_numbers=True
+def _PackNumbers(obj):
+    '返回打包后的dict，不能打包时返回None'
+    if len(obj) == 0:
+        return None
+    _cls = obj[0].__class__
+    if not _cls in (int, float) or any(x.__class__ is not _cls for x in obj):
+        return None
+    try:
+        _array = array.array('q' if _cls is int else 'd', obj)
+    except OverflowError:
+        return None
+    return {'typecode':_array.typecode, 'byteorder':sys.byteorder, 'data':base64.b64encode(_array).decode('ascii')}
+def _UnpackNumbers(data):
+    _array = array.array(data['typecode'], base64.b64decode(data['data']))
+    if data['byteorder'] != sys.byteorder:
+        _array.byteswap()
+    return _array.tolist()
+def list_dumper(ser, obj, define):
+    _r = _PackNumbers(obj) if ser.PackNumbers else None
+    return [ser.Dump(x) for x in obj] if _r is None else _r
 SerializerForJSON.RegisterType([].__class__,
-            {'creator':lambda ser: [], 'loader':lambda ser, data, define: [ser.Load(x) for x in data], 'dumper':lambda ser, obj, define:[ser.Dump(x) for x in obj]})
+            {'creator':lambda ser: [], 'loader':lambda ser, data, define: _UnpackNumbers(data) if isinstance(data, dict) else [ser.Load(x) for x in data], 'dumper':list_dumper})
 SerializerForJSON.RegisterType(().__class__,
             {'creator':lambda ser: (), 'loader':lambda ser, data, define: tuple([ser.Load(x) for x in data]), 'dumper':lambda ser, obj, define:[ser.Dump(x) for x in obj]})
 def dict_loader(ser, data, define):
@@ -424,6 +450,33 @@ class DumpedZipper(object):
             return zlib.decompress(data[4:]).decode()
         return data
     
+#可选：numpy数组。dtype、shape与原始数据整体编码，不逐元素Dump；
+#序列化器带DumpedZipper过滤器时原始数据先经zlib压缩（压缩base64文本的效果差）。载入时np.frombuffer直接引用解码后的数据，得到的数组只读
+#dtype以numpy.lib.format的descr表示（与.npy文件相同），嵌套的结构化dtype经JSON往返后仍可还原
+try:
+    import numpy
+    from numpy.lib.format import dtype_to_descr, descr_to_dtype
+except ImportError:
+    numpy = None
+def ndarray_dumper(ser, obj, define):
+    if obj.dtype.hasobject:
+        raise TypeError('ndarray of objects not supported')
+    _data = numpy.ascontiguousarray(obj).data
+    _r = {'dtype':dtype_to_descr(obj.dtype), 'shape':list(obj.shape)}
+    if any(_filter is DumpedZipper for _filter in ser._Filters):
+        _data = zlib.compress(_data)
+        _r['zlib'] = True
+    _r['data'] = base64.b64encode(_data).decode('ascii')
+    return _r
+def ndarray_loader(ser, data, define):
+    _data = base64.b64decode(data['data'])
+    if data.get('zlib'):
+        _data = zlib.decompress(_data)
+    return numpy.frombuffer(_data, dtype=descr_to_dtype(data['dtype'])).reshape(data['shape'])
+if not numpy is None:
+    SerializerForJSON.RegisterType(numpy.ndarray,
+            {'creator':lambda ser: numpy.empty(0), 'loader':ndarray_loader, 'dumper':ndarray_dumper})
+
 ##############################
 ##############################
 
@@ -496,5 +549,14 @@ def test_SerializerForJSON():
     _obj_new = _ser2.Load(_dumped)
     print('obj_new:    ', str(_obj_new))
 
+    print('-'*10, '数值打包')
+    _ser5 = SerializerForJSON(filters=[DumpedZipper], pack_numbers=True)
+    _objs = [[1, 2, 3], [0.5, 1.5]]
+    if not numpy is None:
+        _objs.append(numpy.arange(6, dtype='<f8').reshape(2, 3))
+    for _obj in _objs:
+        _str = _ser5.DumpedToString(_ser5.Dump(_obj))
+        print('dumped:', _ser5.Dump(_obj), len(_str), '    loaded:', repr(_ser5.Load(_ser5.DumpedFromString(_str))))
+
 if __name__ == '__main__':
     test_SerializerForJSON()
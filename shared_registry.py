@@ -0,0 +1,246 @@
+#coding: utf-8
+'''
+Created on 2026年10月19日
+
+基于multiprocessing.shared_memory的跨进程注册库
+
+一个写进程（SharedRegistryWriter）在本地维护注册项，Publish时将全部注册项编码后写入一个新的共享内存段（一代），
+段中包含哈希索引，读进程（SharedRegistryReader）无需复制即可按名称定位并解码值。
+控制段（以注册库名称命名）记录当前代号与数据段名称，以序号锁（seqlock）方式更新：
+写进程更新前后各递增一次序号，读进程读到奇数序号或前后序号不一致时重新读取。
+读进程在一次调用中只访问同一代的数据段，旧的数据段在发布新一代后被unlink，已打开它的读进程仍可继续使用直到刷新。
+
+注册项名称必须是字符串
+'''
+import time
+import struct
+import hashlib
+from multiprocessing import shared_memory
+
+from pcs_base.key_value import Registry, _SnapshotEncode, _SnapshotDecode
+from pcs_base.Common import ATTACH_SHARED_MEMORY
+
+#控制段：序号，代号，数据段名称
+_NAME_SIZE = 64
+_CONTROL = struct.Struct('<QQ%ds' % _NAME_SIZE)
+#数据段名称为'注册库名称_代号'，代号最多20位十进制数字
+_GENERATION_DIGITS = 20
+#数据段头部：标志，条目数，桶数
+_SEGMENT_HEADER = struct.Struct('<4sQQ')
+_SEGMENT_MAGIC = b'SKV!'
+#哈希桶：名称哈希（0表示空桶），条目偏移，名称长度，值长度
+_BUCKET = struct.Struct('<QQII')
+
+def _Hash(key):
+    '跨进程稳定的名称哈希。str的hash()受PYTHONHASHSEED影响，不能使用'
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') | 1
+
+class SharedRegistryWriter(Registry):
+    '''
+            共享注册库的写端
+        注册项的增删与本地Registry一致，调用Publish后才对读进程可见
+    '''
+    def __init__(self, name, serializer=None, **kwargs):
+        super(SharedRegistryWriter, self).__init__(**kwargs)
+        #struct会静默截断超长的数据段名称，读进程将无法打开
+        if len(name.encode('utf8')) + 1 + _GENERATION_DIGITS > _NAME_SIZE:
+            raise ValueError('name of shared registry "%s" is too long' % name)
+        self.Name = name
+        self.Serializer = serializer
+        self.__generation = 0
+        self.__segment = None
+        self.__control = shared_memory.SharedMemory(name=name, create=True, size=_CONTROL.size)
+        _CONTROL.pack_into(self.__control.buf, 0, 0, 0, b'')
+
+    @property
+    def Generation(self):
+        return self.__generation
+
+    def Publish(self):
+        '将当前全部注册项写入新一代数据段并切换读进程的可见版本，返回新的代号'
+        with self._Lock:
+            _entries = []
+            for _name, _value in self.items():
+                if not isinstance(_name, str):
+                    raise TypeError('name of shared registry must be str, not %s' % _name.__class__.__name__)
+                _entries.append((_name.encode('utf8'), _SnapshotEncode(self.Serializer, _value)))
+            _buckets = 8
+            while _buckets < len(_entries) * 2:
+                _buckets *= 2
+            _offset = _SEGMENT_HEADER.size + _BUCKET.size * _buckets
+            _size = _offset + sum(len(_k) + len(_v) for _k, _v in _entries)
+            _generation = self.__generation + 1
+            _segment = shared_memory.SharedMemory(name='%s_%d' % (self.Name, _generation), create=True, size=_size)
+            _buf = _segment.buf
+            _SEGMENT_HEADER.pack_into(_buf, 0, _SEGMENT_MAGIC, len(_entries), _buckets)
+            _mask = _buckets - 1
+            for _key, _data in _entries:
+                _slot = _Hash(_key) & _mask
+                while _BUCKET.unpack_from(_buf, _SEGMENT_HEADER.size + _BUCKET.size * _slot)[0] != 0:
+                    _slot = (_slot + 1) & _mask
+                _BUCKET.pack_into(_buf, _SEGMENT_HEADER.size + _BUCKET.size * _slot, _Hash(_key), _offset, len(_key), len(_data))
+                _buf[_offset:_offset+len(_key)] = _key
+                _buf[_offset+len(_key):_offset+len(_key)+len(_data)] = _data
+                _offset += len(_key) + len(_data)
+            del _buf
+            #seqlock：先将序号置为奇数，写入后再置为偶数
+            _seq = _CONTROL.unpack_from(self.__control.buf, 0)[0]
+            struct.pack_into('<Q', self.__control.buf, 0, _seq + 1)
+            _CONTROL.pack_into(self.__control.buf, 0, _seq + 1, _generation, _segment.name.encode('utf8'))
+            struct.pack_into('<Q', self.__control.buf, 0, _seq + 2)
+            if not self.__segment is None:
+                self.__segment.close()
+                self.__segment.unlink()
+            self.__segment = _segment
+            self.__generation = _generation
+            return _generation
+
+    def Close(self):
+        '删除控制段及当前数据段，读进程已打开的数据段仍可继续访问'
+        with self._Lock:
+            if not self.__segment is None:
+                self.__segment.close()
+                self.__segment.unlink()
+                self.__segment = None
+            if not self.__control is None:
+                self.__control.close()
+                self.__control.unlink()
+                self.__control = None
+
+class SharedRegistryReader(object):
+    '''
+            共享注册库的读端
+        提供与Registry一致的Get/Has/Names/Count接口，值在每次Get时从共享内存中解码
+        auto_refresh为True时每次调用前检查是否有新一代发布；为False时固定在当前代，需显式调用Refresh
+    '''
+    #等待写进程完成控制段更新的最长时间（秒）
+    CONTROL_TIMEOUT = 1.0
+
+    def __init__(self, name, serializer=None, auto_refresh=True):
+        super(SharedRegistryReader, self).__init__()
+        self.Name = name
+        self.Serializer = serializer
+        self.AutoRefresh = auto_refresh
+        self.__control = ATTACH_SHARED_MEMORY(name)
+        self.__segment = None
+        self.__generation = 0
+        self.__count = 0
+        self.__mask = 0
+        self.Refresh()
+
+    @property
+    def Generation(self):
+        return self.__generation
+
+    def __ReadControl(self):
+        '''
+                读取控制段。序号为奇数表示写进程正在更新，让出CPU后重试
+            超过CONTROL_TIMEOUT秒仍未读到一致的内容（写进程在更新中途退出）时抛出TimeoutError
+        '''
+        _buf = self.__control.buf
+        _deadline = None
+        while True:
+            _seq, _generation, _name = _CONTROL.unpack_from(_buf, 0)
+            if not _seq & 1 and struct.unpack_from('<Q', _buf, 0)[0] == _seq:
+                return _generation, _name.rstrip(b'\0').decode('utf8')
+            if _deadline is None:
+                _deadline = time.monotonic() + self.CONTROL_TIMEOUT
+            elif time.monotonic() > _deadline:
+                raise TimeoutError('control segment of "%s" is not consistent, writer may have died while publishing' % self.Name)
+            time.sleep(0)
+
+    def Refresh(self):
+        '''
+                切换到最新发布的一代，返回当前代号
+            超过CONTROL_TIMEOUT秒仍无法打开控制段所记录的数据段时抛出TimeoutError
+        '''
+        _deadline = None
+        while True:
+            _generation, _name = self.__ReadControl()
+            if _generation == self.__generation:
+                return _generation
+            try:
+                _segment = ATTACH_SHARED_MEMORY(_name)
+                break
+            except FileNotFoundError:
+                #读取控制段后写进程又发布了新一代并删除了该段，重新读取控制段
+                if _deadline is None:
+                    _deadline = time.monotonic() + self.CONTROL_TIMEOUT
+                elif time.monotonic() > _deadline:
+                    raise TimeoutError('segment "%s" of "%s" not found' % (_name, self.Name))
+                time.sleep(0)
+        _magic, _count, _buckets = _SEGMENT_HEADER.unpack_from(_segment.buf, 0)
+        if _magic != _SEGMENT_MAGIC:
+            _segment.close()
+            raise ValueError('invalid shared registry segment "%s"' % _name)
+        if not self.__segment is None:
+            self.__segment.close()
+        self.__segment = _segment
+        self.__generation = _generation
+        self.__count = _count
+        self.__mask = _buckets - 1
+        return _generation
+
+    def __Find(self, name):
+        '返回(值偏移, 值长度)，不存在时返回None'
+        if self.AutoRefresh:
+            self.Refresh()
+        if self.__segment is None:
+            return None
+        _key = name.encode('utf8') if isinstance(name, str) else b''
+        _hash = _Hash(_key)
+        _buf = self.__segment.buf
+        _slot = _hash & self.__mask
+        while True:
+            _h, _offset, _key_len, _value_len = _BUCKET.unpack_from(_buf, _SEGMENT_HEADER.size + _BUCKET.size * _slot)
+            if _h == 0:
+                return None
+            if _h == _hash and _buf[_offset:_offset+_key_len] == _key:
+                return _offset + _key_len, _value_len
+            _slot = (_slot + 1) & self.__mask
+
+    @property
+    def Count(self):
+        if self.AutoRefresh:
+            self.Refresh()
+        return self.__count
+
+    def Get(self, name, **kwargs):
+        '获取注册项的值'
+        _pos = self.__Find(name)
+        if _pos is None:
+            if 'default' in kwargs:
+                return kwargs['default']
+            raise KeyError('"%s" not found' % name)
+        _offset, _length = _pos
+        return _SnapshotDecode(self.Serializer, self.__segment.buf[_offset:_offset+_length])
+
+    def Has(self, name):
+        '检查注册项是否存在'
+        return not self.__Find(name) is None
+
+    def Names(self):
+        '所有已注册的名称，顺序与写端一致'
+        if self.AutoRefresh:
+            self.Refresh()
+        if self.__segment is None:
+            return []
+        _buf = self.__segment.buf
+        _r = []
+        for _slot in range(self.__mask + 1):
+            _h, _offset, _key_len, _ = _BUCKET.unpack_from(_buf, _SEGMENT_HEADER.size + _BUCKET.size * _slot)
+            if _h != 0:
+                _r.append((_offset, bytes(_buf[_offset:_offset+_key_len]).decode('utf8')))
+        _r.sort()
+        return [_name for _, _name in _r]
+
+    def Close(self):
+        if not self.__segment is None:
+            self.__segment.close()
+            self.__segment = None
+        if not self.__control is None:
+            self.__control.close()
+            self.__control = None
+
+    def __str__(self):
+        return '<%s Name=%s Generation=%d Count=%d>' % (self.__class__.__name__, self.Name, self.__generation, self.__count)
@@ -0,0 +1,301 @@
+#coding: utf-8
+'''
+Created on 2026年10月19日
+
+基于multiprocessing.shared_memory的进程间对象传递
+
+发送方（SharedMemorySender）将对象直接编码到一个新的共享内存段中，只把很小的SharedHandle（段名称、大小、读者序号）交给接收方。
+serializer为None时使用pickle协议5：支持带外缓冲区的对象（numpy数组、bytearray等）的数据不经过pickle字节流，
+直接复制到段中，接收方（SharedMemoryReceiver）在段上以memoryview重建，不再复制；否则使用serializer（如SerializerForJSON）编码。
+
+段的回收：
+    段头部为每个读者保留一个标志字节，读者Release后置1，所有标志均为1的段在发送方Collect时被删除；
+    lease不为None时，超过租期的段无论是否被读取都会被删除。
+    Collect在每次Send时执行，有未回收的段时发送端的后台线程还会每collect_interval秒执行一次
+'''
+import os
+import time
+import pickle
+import struct
+import itertools
+import collections
+from threading import Lock, Event, Thread
+from multiprocessing import shared_memory
+
+from pcs_base.Common import ATTACH_SHARED_MEMORY
+
+#段头部（在读者标志之后）：标志，编码方式，带外缓冲区数
+_HEADER = struct.Struct('<4sBI')
+_MAGIC = b'SMT!'
+_CODEC_PICKLE = 1
+_CODEC_SERIALIZER = 2
+#带外缓冲区按此对齐，便于numpy等直接使用
+_ALIGN = 64
+
+SharedHandle = collections.namedtuple('SharedHandle', 'name size slot readers')
+
+def _Aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+class SharedMemorySender(object):
+    '''
+            共享内存传输的发送端
+        段由创建它的发送端删除，发送端所在进程须在接收方读取完成（或租期到达）之前保持存活
+    '''
+    def __init__(self, serializer=None, lease=None, prefix=None, collect_interval=1.0):
+        super(SharedMemorySender, self).__init__()
+        self.Serializer = serializer
+        #段的租期（秒），None表示只在所有读者Release后回收
+        self.Lease = lease
+        self.Prefix = 'smt_%d_%x' % (os.getpid(), id(self)) if prefix is None else prefix
+        #后台回收的间隔（秒），None表示只在Send及显式调用Collect时回收
+        self.CollectInterval = collect_interval
+        self.__counter = itertools.count()
+        self.__segments = {}            #key=段名称, value=(SharedMemory, 读者数, 到期时间)
+        self.__lock = Lock()
+        self.__thread = None
+        self.__closed = Event()
+
+    @property
+    def Pending(self):
+        '尚未回收的段数'
+        return len(self.__segments)
+
+    def __Encode(self, obj):
+        '返回(编码方式, 主数据, [带外缓冲区, ...])'
+        if self.Serializer is None:
+            _buffers = []
+            _data = pickle.dumps(obj, protocol=5, buffer_callback=_buffers.append)
+            return _CODEC_PICKLE, _data, [x.raw() for x in _buffers]
+        _data = self.Serializer.DumpedToString(self.Serializer.Dump(obj))
+        return _CODEC_SERIALIZER, _data.encode('utf8') if isinstance(_data, str) else _data, []
+
+    def Send(self, obj, readers=1):
+        '''
+                将obj写入新的共享内存段
+            readers为1时返回SharedHandle，否则返回每个读者各一个的SharedHandle列表，每个读者须使用不同的handle
+        '''
+        self.Collect()
+        _codec, _data, _buffers = self.__Encode(obj)
+        _table = struct.Struct('<%dQ' % (len(_buffers) + 1))
+        _offset = readers + _HEADER.size + _table.size
+        _buffer_offsets = []
+        _end = _offset + len(_data)
+        for _buffer in _buffers:
+            _end = _Aligned(_end)
+            _buffer_offsets.append(_end)
+            _end += _buffer.nbytes
+        _name = '%s_%d' % (self.Prefix, next(self.__counter))
+        _segment = shared_memory.SharedMemory(name=_name, create=True, size=max(_end, 1))
+        _buf = _segment.buf
+        _buf[:readers] = bytes(readers)
+        _HEADER.pack_into(_buf, readers, _MAGIC, _codec, len(_buffers))
+        _table.pack_into(_buf, readers + _HEADER.size, len(_data), *[x.nbytes for x in _buffers])
+        _buf[_offset:_offset+len(_data)] = _data
+        for _buffer, _buffer_offset in zip(_buffers, _buffer_offsets):
+            _buf[_buffer_offset:_buffer_offset+_buffer.nbytes] = _buffer.cast('B')
+        del _buf
+        with self.__lock:
+            self.__segments[_name] = (_segment, readers, None if self.Lease is None else time.monotonic() + self.Lease)
+            if self.__thread is None and not self.CollectInterval is None:
+                self.__thread = Thread(target=self.__Run, name='SharedMemorySender', daemon=True)
+                self.__thread.start()
+        _handles = [SharedHandle(_name, _end, _slot, readers) for _slot in range(readers)]
+        return _handles[0] if readers == 1 else _handles
+
+    def __Run(self):
+        '后台回收，没有未回收的段时退出，下次Send时重新启动'
+        while not self.__closed.wait(self.CollectInterval):
+            self.Collect()
+            with self.__lock:
+                if not self.__segments:
+                    self.__thread = None
+                    return
+
+    def Collect(self):
+        '删除所有读者均已Release或租期已到的段，返回删除的段数'
+        _now = time.monotonic()
+        with self.__lock:
+            _names = [_name for _name, (_segment, _readers, _deadline) in self.__segments.items()
+                      if bytes(_segment.buf[:_readers]) == b'\x01' * _readers or (not _deadline is None and _deadline <= _now)]
+            _segments = [self.__segments.pop(_name)[0] for _name in _names]
+        for _segment in _segments:
+            _segment.close()
+            _segment.unlink()
+        return len(_segments)
+
+    def Close(self):
+        '停止后台回收并删除全部段'
+        self.__closed.set()
+        with self.__lock:
+            _thread = self.__thread
+            _segments = [x[0] for x in self.__segments.values()]
+            self.__segments.clear()
+        if not _thread is None:
+            _thread.join()
+        for _segment in _segments:
+            _segment.close()
+            _segment.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+class SharedMemoryReceiver(object):
+    '''
+            共享内存传输的接收端
+        pickle编码且含带外缓冲区时，得到的对象直接引用共享内存（numpy数组等），段保持打开直到Release；
+        其他情况下段在Receive完成后即被Release
+    '''
+    def __init__(self, serializer=None):
+        super(SharedMemoryReceiver, self).__init__()
+        self.Serializer = serializer
+        self.__open = {}                #key=SharedHandle, value=[SharedMemory, 是否已置标志]
+
+    def Receive(self, handle):
+        '载入handle对应的对象'
+        try:
+            _segment = ATTACH_SHARED_MEMORY(handle.name)
+        except FileNotFoundError:
+            raise KeyError('"%s" not found' % handle.name)
+        _buf = _segment.buf
+        _offset = handle.readers
+        _magic, _codec, _count = _HEADER.unpack_from(_buf, _offset)
+        if _magic != _MAGIC:
+            del _buf
+            _segment.close()
+            raise ValueError('invalid segment "%s"' % handle.name)
+        _offset += _HEADER.size
+        _lengths = struct.unpack_from('<%dQ' % (_count + 1), _buf, _offset)
+        _offset += 8 * (_count + 1)
+        _data = _buf[_offset:_offset+_lengths[0]]
+        if _codec == _CODEC_PICKLE:
+            _buffers = []
+            _end = _offset + _lengths[0]
+            for _length in _lengths[1:]:
+                _end = _Aligned(_end)
+                _buffers.append(_buf[_end:_end+_length])
+                _end += _length
+            _r = pickle.loads(_data, buffers=_buffers)
+            del _buffers
+        else:
+            _r = self.Serializer.Load(self.Serializer.DumpedFromString(bytes(_data)))
+        _data.release()
+        del _buf
+        self.__open[handle] = [_segment, False]
+        if _count == 0:
+            self.Release(handle)
+        return _r
+
+    def Release(self, handle):
+        '''
+                通知发送端本读者已不再使用该段
+            对象仍引用段中的数据时，关闭映射会失败，此时保持映射直到对象被释放后再次调用Release。
+            标志只在首次调用时设置：关闭失败后SharedMemory.buf已不可用，但本进程的映射仍然有效，发送端删除段不影响对象继续使用
+        '''
+        _opened = self.__open.get(handle)
+        if _opened is None:
+            return
+        _segment, _flagged = _opened
+        if not _flagged:
+            _segment.buf[handle.slot] = 1
+            _opened[1] = True
+        try:
+            _segment.close()
+        except BufferError:
+            return
+        del self.__open[handle]
+
+    def Close(self):
+        for _handle in list(self.__open):
+            self.Release(_handle)
+
+##############################
+##############################
+
+def _BenchmarkConsumer(queue, results, mode):
+    _receiver = SharedMemoryReceiver()
+    _total = 0
+    while True:
+        _item = queue.get()
+        if _item is None:
+            break
+        if mode == 'shm':
+            _obj = _receiver.Receive(_item)
+            _total += len(_obj)
+            del _obj
+            _receiver.Release(_item)
+        else:
+            _total += len(_item)
+    results.put(_total)
+
+def benchmark_SharedMemoryTransport(count=200, size=8<<20):
+    '对比multiprocessing.Queue直接传递对象与只传递SharedHandle的吞吐'
+    import multiprocessing
+    try:
+        import numpy
+        _payload = numpy.random.rand(size // 8)
+    except ImportError:
+        _payload = bytearray(os.urandom(size))
+    for _mode in ['queue', 'shm']:
+        _queue = multiprocessing.Queue(8)
+        _results = multiprocessing.Queue()
+        _process = multiprocessing.Process(target=_BenchmarkConsumer, args=(_queue, _results, _mode))
+        _process.start()
+        with SharedMemorySender(lease=60) as _sender:
+            _t = time.time()
+            for _ in range(count):
+                _queue.put(_sender.Send(_payload) if _mode == 'shm' else _payload)
+            _queue.put(None)
+            _results.get()
+            _elapsed = time.time() - _t
+            _process.join()
+            print('%-8s%8.1f MB/s  pending=%d' % (_mode, count * size / _elapsed / (1 << 20), _sender.Pending))
+
+def test_SharedMemoryTransport():
+    from pcs_base.serializer import SerializerForJSON
+    _data = dict(a=1, b=[1, 2, 3], c=bytearray(b'abc' * 1000))
+    with SharedMemorySender(lease=0.2) as _sender:
+        _receiver = SharedMemoryReceiver()
+        _handles = _sender.Send(_data, readers=2)
+        for _handle in _handles:
+            _obj = _receiver.Receive(_handle)
+            assert _obj == _data
+            del _obj
+            _receiver.Release(_handle)
+        assert _sender.Collect() == 1
+        _handle = _sender.Send('unread')
+        time.sleep(0.3)
+        assert _sender.Collect() == 1
+        try:
+            _receiver.Receive(_handle)
+            assert False
+        except KeyError:
+            pass
+    _serializer = SerializerForJSON()
+    with SharedMemorySender(_serializer) as _sender:
+        _receiver = SharedMemoryReceiver(_serializer)
+        _handle = _sender.Send({'x': [1, 2.5, 'abc']})
+        print(_handle, _receiver.Receive(_handle))
+        assert _sender.Collect() == 1
+    try:
+        import numpy
+    except ImportError:
+        return
+    #对象仍引用段中的数据时Release不关闭映射，对象释放后再次Release；段由后台线程回收
+    with SharedMemorySender(collect_interval=0.05) as _sender:
+        _receiver = SharedMemoryReceiver()
+        _handle = _sender.Send(numpy.arange(1000))
+        _array = _receiver.Receive(_handle)
+        _receiver.Release(_handle)
+        time.sleep(0.2)
+        assert _sender.Pending == 0 and _array.sum() == 499500
+        del _array
+        _receiver.Release(_handle)
+        _receiver.Close()
+
+if __name__ == '__main__':
+    test_SharedMemoryTransport()
+    benchmark_SharedMemoryTransport()